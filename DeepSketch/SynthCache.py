@@ -4,14 +4,77 @@ import sys
 import shutil
 import pickle
 import subprocess
-from data import get_cache_file
-from external.regexDFAEquals import unprocess_regex, silent_eual_test
+import threading
+import heapq
+import multiprocessing as mp
+from data import get_cache_file, get_cache_log_file, get_cache_index_file
+from cache_store import LogStore, LogIndex, LogCheckpointer, CACHE_STORES, owner_lock
+from cache_table import SynthTable, RESULT_INDEX, EVICTION_POLICIES, EVICT_TO
+from cache_stats import CacheStats
+from grammar import canonical_sketch, canonical_regex, valid_sketch, valid_regex
+from external.regexDFAEquals import unprocess_regex, silent_eual_test, silent_native_eual_test, native_regex_equiv, \
+    silent_native_eual_many, gold_fingerprints
 import random
 import time
 
+# java -Djava.library.path=external/lib -cp external/resnax.jar:external/lib/* -ea resnax.Main 1 $1 $2 $3
+SYNTH_JAVA = ["java", "-Djava.library.path=external/lib", "-cp", "external/resnax.jar:external/lib/*", "-ea"]
+
+def synth_mode(dataset):
+    if dataset.startswith("TurkSketch"):
+        return "1"
+    if dataset.startswith("KB13Sketch"):
+        return "2"
+    raise ValueError("No synthesizer for dataset {}".format(dataset))
+
+# seconds a synthesizer call gets in one oracle pass unless a budget schedule says otherwise
+def synth_timeout(dataset):
+    if dataset.startswith("TurkSketch"):
+        return 2
+    if dataset.startswith("KB13Sketch"):
+        return 4
+    raise ValueError("No synthesizer for dataset {}".format(dataset))
+
+def parse_synth_output(out):
+    if "true" in out:
+        return "true"
+    elif "false" in out:
+        return "false"
+    elif "wrong" in out:
+        return "wrong"
+    elif "null" in out:
+        return "null"
+    elif "empty" in out:
+        return "empty"
+    return "wrong"
+
+# one fresh JVM per sketch
+def synth_command(mode, split, id, sketch):
+    return SYNTH_JAVA + ["resnax.Main", mode, split, str(id), sketch]
+
+# result of the synthesizer on a sketch: true/false/wrong/null/empty/timeout
+def run_synthesizer(mode, split, id, sketch, timeout):
+    cmd = synth_command(mode, split, id, sketch)
+    try:
+        out = str(subprocess.check_output(cmd, stderr=subprocess.DEVNULL, timeout=timeout))
+        result = parse_synth_output(out)
+    except subprocess.TimeoutExpired:
+        result = "timeout"
+    except subprocess.CalledProcessError:
+        result = "wrong"
+    except ValueError:
+        result = "wrong"
+        print("Value Error", split, id, sketch)
+        print("Value Error!!!!!!", split, id, sketch, file=sys.stderr)
+    return result
+
+# DFA equivalence engines: "jar" runs regex_dfa_equals.jar once per pair,
+# "native" decides it in-process with external/regexDFA.py
+DFA_ENGINES = ["native", "jar"]
+
 class DFAWorker:
-    def __init__(self):
-        pass
+    def __init__(self, engine="native"):
+        self.engine = engine
 
     def run(self, pair):
         gold, predicted = pair
@@ -19,6 +82,8 @@ class DFAWorker:
         predicted = unprocess_regex(predicted)
         if gold == predicted:
             return "true"
+        if self.engine == "native":
+            return native_regex_equiv(gold, predicted)
         try:
             out = subprocess.check_output(
                 ['java', '-jar', './external/regex_dfa_equals.jar', '{}'.format(gold), '{}'.format(predicted)], timeout=2)
@@ -30,257 +95,888 @@ class DFAWorker:
             return "false"
         return "false"
 
+    # task is (gold, [predicted, ...], fingerprint of gold or None)
+    def run_many(self, task):
+        if self.engine != "native":
+            return [self.run((task[0], predicted)) for predicted in task[1]]
+        return ["true" if x == "perfect" else x for x in silent_native_eual_many(task)]
+
+    # run_many and the seconds it took per pair
+    def timed_run_many(self, task):
+        t_start = time.monotonic()
+        results = self.run_many(task)
+        return results, (time.monotonic() - t_start) / max(len(task[1]), 1)
+
 class SynthWorker:
-    def __init__(self, dataset, split):
+    def __init__(self, dataset, split, budget=None):
         self.split = split
-        if dataset.startswith("TurkSketch"):
-            self.timeout = 2
-            self.mode = "1"
-        if dataset.startswith("KB13Sketch"):
-            self.timeout = 4
-            self.mode = "2"
+        self.mode = synth_mode(dataset)
+        self.timeout = synth_timeout(dataset) if budget is None else budget
 
-    def run(self, sketch):
-        # java -Djava.library.path=external/lib -cp external/resnax.jar:external/lib/* -ea resnax.Main 1 $1 $2 $3
-        cmd = ["java", "-Djava.library.path=external/lib", "-cp", "external/resnax.jar:external/lib/*", "-ea", "resnax.Main", self.mode, self.split, str(sketch[0]), sketch[1]]
-        try:
-            # out = str(subprocess.check_output(cmd, stderr=subprocess.DEVNULL, timeout=self.timeout))
-            out = str(subprocess.check_output(cmd, stderr=subprocess.DEVNULL, timeout=self.timeout))
-            if "true" in out:
-                result = "true"
-            elif "false" in out:
-                result = "false"
-            elif "wrong" in out:
-                result = "wrong"
-            elif "null" in out:
-                result = "null"
-            elif "empty" in out:
-                result = "empty"
-        except subprocess.TimeoutExpired:
-            result = "timeout"
-        except subprocess.CalledProcessError:
-            result = "wrong"
-        except ValueError:
-            result = "wrong"
+    def command(self, sketch):
+        return synth_command(self.mode, self.split, sketch[0], sketch[1])
 
-        return result
+    def run(self, sketch):
+        return run_synthesizer(self.mode, self.split, sketch[0], sketch[1], self.timeout)
 
     def timed_run(self, sketch):
         t_start = time.monotonic()
         result = self.run(sketch)
         return result, (time.monotonic() - t_start)
 
+# Iterative deepening over synthesizer budgets: every candidate is run under the smallest
+# budget and only those that timed out are run again under the next one. run_stage(budget,
+# to_tests) returns the results of one pass. floors[k] is a budget candidate k is already
+# known to time out under, smaller stages are skipped for it. Returns the results and the
+# budget each of them was computed under.
+def run_budget_stages(budgets, to_test_pool, run_stage, floors=None):
+    results = [None] * len(to_test_pool)
+    used = [None] * len(to_test_pool)
+    todo = list(range(len(to_test_pool)))
+    for budget in sorted(budgets):
+        stage = [k for k in todo if floors is None or (floors[k] or 0) < budget]
+        if stage:
+            for k, result in zip(stage, run_stage(budget, [to_test_pool[k] for k in stage])):
+                results[k] = result
+                used[k] = budget
+        todo = [k for k in todo if results[k] is None or results[k] == "timeout"]
+    return results, used
+
+# A candidate that does not parse would only cost an oracle call to come back "wrong" (a
+# sketch) or "false" (a regex), so it is answered here and left out of the pool: its positions
+# in batch_results get result. They are not cached, the check is cheaper than a lookup.
+# Returns to_test_pool and id_pool without them.
+def answer_malformed(cache, to_test_pool, id_pool, well_formed, result, batch_results):
+    kept_tests = []
+    kept_ids = []
+    for to_test, ids in zip(to_test_pool, id_pool):
+        if well_formed(to_test):
+            kept_tests.append(to_test)
+            kept_ids.append(ids)
+        else:
+            for i, j in ids:
+                batch_results[i][j] = result
+    num_saved = len(to_test_pool) - len(kept_tests)
+    if num_saved:
+        cache.stats.saved_malformed(num_saved)
+        print("Syntax check saved {} of {} oracle calls".format(num_saved, len(to_test_pool)), file=sys.stderr)
+    return kept_tests, kept_ids
+
+# (example id, sketch) pairs and (gold, predicted) regex pairs
+def well_formed_sketch(to_test):
+    return valid_sketch(to_test[1])
+
+# Looks up sketch_lists[i], the sketches of example ids[i], in the cache. Returns batch_results,
+# the cached results with None where the oracle has to run, to_test_pool, every distinct
+# (id, canonical sketch) the cache has no answer for, and id_pool, the (example, rank) positions
+# of each of them. Sketches that do not parse are answered "wrong" and left out of the pool.
+def pool_sketch_queries(cache, split, ids, sketch_lists):
+    # pick up what concurrent jobs sharing the cache found since it was loaded
+    cache.refresh()
+    batch_results = []
+    id_pool = []
+    to_test_pool = []
+    pending = {}
+    for i, sketches in enumerate(sketch_lists):
+        single_results = []
+        for j, sketch in enumerate(sketches):
+            sketch = canonical_sketch(sketch)
+            result = cache.soft_query(split, ids[i], sketch)
+            if result is None:
+                to_test = (ids[i], sketch)
+                if to_test not in pending:
+                    pending[to_test] = len(to_test_pool)
+                    to_test_pool.append(to_test)
+                    id_pool.append([])
+                id_pool[pending[to_test]].append((i, j))
+            single_results.append(result)
+        batch_results.append(single_results)
+    to_test_pool, id_pool = answer_malformed(cache, to_test_pool, id_pool, well_formed_sketch, "wrong", batch_results)
+    return batch_results, to_test_pool, id_pool
+
+# Runs the pool of pool_sketch_queries through run_stage(budget, to_tests) under the budget
+# schedule of the cache, writes the results to the cache and fills them into batch_results.
+# A sketch skipped as a predicted timeout (None from run_stage) counts as one, but is not cached.
+def run_sketch_queries(cache, split, to_test_pool, id_pool, batch_results, run_stage):
+    floors = [cache.budget_of(split, id, sketch) for id, sketch in to_test_pool]
+    results_pool, budgets = run_budget_stages(cache.budget_schedule, to_test_pool, run_stage, floors)
+    num_skipped = 0
+    for res_id, to_test in enumerate(to_test_pool):
+        result = results_pool[res_id]
+        if result is None:
+            result = "timeout"
+            num_skipped += 1
+        else:
+            cache.soft_write(split, to_test[0], to_test[1], result, budgets[res_id])
+        for i, j in id_pool[res_id]:
+            batch_results[i][j] = result
+    cache.stats.skipped_timeouts(num_skipped)
+    return batch_results
+
+def well_formed_regex_pair(to_test):
+    # a prediction equal to its gold is answered before either is parsed
+    return valid_regex(to_test[1]) or unprocess_regex(to_test[0]) == unprocess_regex(to_test[1])
+
+# Workers registered with an OraclePool are shipped to the pool processes once, through the
+# pool initializer, and tasks name the worker they run on instead of carrying it along.
+_oracle_workers = {}
+
+def _install_oracle_workers(workers):
+    global _oracle_workers
+    _oracle_workers = workers
+
+def _call_oracle_worker(task):
+    name, method, arg = task
+    return getattr(_oracle_workers[name], method)(arg)
+
+class OraclePool(object):
+    # one process pool shared by every oracle call of a run. The processes are started
+    # lazily and restarted when a new worker is registered or when one of them died,
+    # in which case the interrupted map is run again (oracle calls are pure).
+    def __init__(self, size=5, poll_interval=5):
+        self.size = size
+        self.poll_interval = poll_interval
+        self.workers = {}
+        self.pool = None
+
+    def register(self, name, worker):
+        if name in self.workers:
+            return
+        self.workers[name] = worker
+        self.stop()
+
+    def healthy(self):
+        return self.pool is not None and all(p.exitcode is None for p in self.pool._pool)
+
+    def start(self):
+        if self.healthy():
+            return self.pool
+        self.stop()
+        self.pool = mp.Pool(self.size, initializer=_install_oracle_workers, initargs=(self.workers,))
+        return self.pool
+
+    def map(self, name, method, args, retries=1, chunksize=None):
+        if not args:
+            return []
+        tasks = [(name, method, x) for x in args]
+        for attempt in range(retries + 1):
+            pool = self.start()
+            procs = list(pool._pool)
+            async_result = pool.map_async(_call_oracle_worker, tasks, chunksize)
+            while True:
+                try:
+                    return async_result.get(self.poll_interval)
+                except mp.TimeoutError:
+                    # a task handed to a process that died is never answered
+                    if any(p.exitcode is not None for p in procs):
+                        print("Oracle pool worker died, restarting the pool", file=sys.stderr)
+                        self.stop()
+                        break
+        raise RuntimeError("Oracle pool failed {} times".format(retries + 1))
+
+    def stop(self):
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def close(self):
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# records of the pickled cache formats
+def read_dfa_pickle(path):
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    for key, result in data.items():
+        # caches written before pairs were unordered used "r1DFADIVr2" keys
+        r1, r2 = key.split("DFADIV", 1) if isinstance(key, str) else key
+        yield ("put", r1, r2, result)
+
+def read_synth_pickle(path, dataset):
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    # caches written before budgets were recorded are a bare dict of results
+    budgets = data.get("budgets", {}) if "results" in data else {}
+    data = data["results"] if "results" in data else data
+    for key, vars in data.items():
+        for sketch, result in vars.items():
+            # keys written before sketches were canonical are re-keyed here
+            budget = budgets.get(key, {}).get(sketch, synth_timeout(dataset))
+            yield ("put", key, canonical_sketch(sketch), result, budget)
+
+# Index data of a log record for LogIndex, None for records that are not entries, and
+# whether a later record of the same key replaces an earlier one. A pair's later result wins;
+# synthesizer results follow the merge rule of SynthCache.absorb, on the result code and
+# the budget in milliseconds packed into the data.
+def dfa_index_entry(record):
+    if record[0] != "put":
+        return None
+    return (record[1], record[2]), RESULT_INDEX[record[3]]
+
+def dfa_supersedes(old, new):
+    return True
+
+def synth_index_entry(record):
+    if record[0] != "put":
+        return None
+    _, key, sketch, result, budget = record
+    # TimedCache results are (result, seconds)
+    result = result[0] if isinstance(result, tuple) else result
+    return (key, sketch), RESULT_INDEX[result] | int(round(budget * 1000)) << 8
+
+def synth_supersedes(old, new):
+    timeout = RESULT_INDEX["timeout"]
+    return old & 0xff == timeout and (new & 0xff != timeout or new >> 8 > old >> 8)
+
+# Equivalence results are symmetric and transitive, so the cache keys on unordered
+# pairs and keeps a union-find over regexes known to be equivalent, with links between
+# classes known to differ. A pair whose classes are already related is answered
+# without running the checker; only observed results are stored in data.
+# With a capacity, the least used pairs are evicted (see cache_table.py) and the union-find
+# is rebuilt from the pairs that are left; equivalent pairs are kept with pin_true.
 class DFACache(object):
-    def __init__(self, cache_id, dataset):
+    def __init__(self, cache_id, dataset, engine="native", store="log", capacity=None, eviction="lru",
+            pin_true=True):
+        if engine not in DFA_ENGINES:
+            raise ValueError("Unknown DFA engine {}".format(engine))
+        if store not in CACHE_STORES:
+            raise ValueError("Unknown cache store {}".format(store))
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy {}".format(eviction))
+        self.capacity = capacity
+        self.eviction = eviction
+        self.pinned = ["true", "perfect"] if pin_true else []
+        self.engine = engine
         self.cache_id = "DFA-" + dataset + '-' + cache_id
         self.cache_file = get_cache_file(self.cache_id)
-        print(self.cache_file)
+        self.log = LogStore(get_cache_log_file(self.cache_id)) if store != "pickle" else None
+        self.index = LogIndex(get_cache_index_file(self.cache_id)) if store == "indexed" else None
+        self.owner_fd = owner_lock(self.cache_file) if self.log is None else None
+        print(self.cache_file if self.log is None else self.log.path)
         self.data = {}
+        self.num_unindexed = 0
+        self.gold_fingerprints = {}
+        self.stats = CacheStats()
+        self.checkpointer = None
 
         self.load()
     
     def load(self):
-        if not os.path.isfile(self.cache_file):
-            self.data = {}
+        self.data = {}
+        self.parent = {}
+        self.size = {}
+        self.unequal = {}
+        # regexes of every class, by root
+        self.members = {}
+        # last use (lru) or number of uses (lfu) of every pair of a bounded cache
+        self.usage = {}
+        # pairs of every regex of a bounded cache, eviction relates them again
+        self.pairs = {}
+        self.clock = 0
+        self.evictions = 0
+        self.limit = self.capacity
+        if self.index is not None and self.log.exists():
+            self.open_index()
+            print("Indexed {} recored".format(len(self.index)))
+            return
+        if self.log is not None and self.log.exists():
+            num_records = 0
+            for _, r1, r2, result in self.log.replay():
+                self.record(r1, r2, result, persist=False)
+                num_records += 1
+            print("Load {} recored".format(self.num_entries()))
+            # a bounded cache only holds part of the log, rewriting it would lose the rest
+            if num_records > 2 * len(self.data) and self.evictions == 0:
+                self.compact()
+            return
+        if os.path.isfile(self.cache_file):
+            for _, r1, r2, result in self.read_pickle():
+                self.record(r1, r2, result, persist=False)
+            print("Load {} recored".format(self.num_entries()))
+            print("{} distinct regexes after canonicalization".format(len(self.parent)))
+            # a bounded cache that evicted while loading leaves the migration to a later run
+            if self.log is not None and self.evictions == 0:
+                print("Migrating {} to {}".format(self.cache_file, self.log.path))
+                self.compact()
+
+    def read_pickle(self):
+        return read_dfa_pickle(self.cache_file)
+
+    # pairs other processes appended to the shared log since the last refresh
+    def refresh(self):
+        if self.index is not None and self.index.mm is not None and self.log.replaced():
+            # another process compacted the log and indexed it again
+            self.open_index()
+            return
+        if self.log is not None:
+            for _, r1, r2, result in self.log.read_new():
+                self.record(r1, r2, result, persist=False)
+
+    # With the indexed store only the pairs a run asks for are read, so the union-find
+    # relates the regexes of those pairs and inference sees fewer transitive results.
+    # Maps the index, rebuilding it when it is missing, stale or covers too little of the
+    # log, and replays the records appended after it.
+    def open_index(self):
+        with self.log.locked():
+            if not self.index.open() or not self.index.valid_for(self.log) \
+                    or self.log.size() - self.index.covered > self.index.covered // 4:
+                self.index.build(self.log, dfa_index_entry, dfa_supersedes)
+            self.log.skip_to(self.index.covered)
+            self.num_unindexed = 0
+        self.refresh()
+
+    # result of a canonical pair read from the index into the cache, None if it is not indexed
+    def fault_in(self, r1, r2):
+        if self.index is None:
+            return None
+        for offset, _ in self.index.candidates((r1, r2)):
+            record = self.log.read_at(offset)
+            if (record[1], record[2]) == (r1, r2):
+                self.record(r1, r2, record[3], persist=False)
+                return record[3]
+        return None
+
+    # with an index, pairs written since it was built are counted once per write
+    def num_entries(self):
+        if self.index is not None:
+            return len(self.index) + self.num_unindexed
+        return len(self.data)
+
+    @staticmethod
+    def pair_key(r1, r2):
+        return (r1, r2) if r1 <= r2 else (r2, r1)
+
+    def find(self, r):
+        if r not in self.parent:
+            return r
+        root = r
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[r] != root:
+            self.parent[r], r = root, self.parent[r]
+        return root
+
+    def add(self, r):
+        if r not in self.parent:
+            self.parent[r] = r
+            self.size[r] = 1
+            self.unequal[r] = set()
+            self.members[r] = [r]
+
+    def union(self, r1, r2):
+        a, b = self.find(r1), self.find(r2)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size.pop(b)
+        self.members[a].extend(self.members.pop(b))
+        # a checker timeout reads as "false", an observed equivalence wins over it
+        self.unequal[a].discard(b)
+        for c in self.unequal.pop(b):
+            if c == a:
+                continue
+            self.unequal[c].discard(b)
+            self.unequal[c].add(a)
+            self.unequal[a].add(c)
+
+    def record(self, r1, r2, result, persist=True):
+        r1, r2 = canonical_regex(r1), canonical_regex(r2)
+        if persist and self.index is not None and self.pair_key(r1, r2) not in self.data:
+            self.num_unindexed += 1
+        self.data[self.pair_key(r1, r2)] = result
+        if persist and self.log is not None:
+            self.log.append(("put",) + self.pair_key(r1, r2) + (result,))
+        self.relate(r1, r2, result)
+        if self.capacity is not None:
+            self.touch(self.pair_key(r1, r2))
+            self.pairs.setdefault(r1, set()).add(self.pair_key(r1, r2))
+            self.pairs.setdefault(r2, set()).add(self.pair_key(r1, r2))
+            if len(self.data) > self.limit:
+                self.evict()
+
+    def relate(self, r1, r2, result):
+        self.add(r1)
+        self.add(r2)
+        if result == "false":
+            a, b = self.find(r1), self.find(r2)
+            if a != b:
+                self.unequal[a].add(b)
+                self.unequal[b].add(a)
         else:
-            with open(self.cache_file, 'rb') as f:
-                self.data = pickle.load(f)
-            print("Load {} recored".format(len(self.data)))
+            self.union(r1, r2)
 
-    def query(self, r1, r2):
-        key = r1 + "DFADIV" + r2
+    def touch(self, key):
+        if self.eviction == "lru":
+            self.clock += 1
+            self.usage[key] = self.clock
+        else:
+            self.usage[key] = self.usage.get(key, 0) + 1
+
+    # Only the classes of the evicted pairs are taken apart and related again from the pairs
+    # that are left, the rest of the union-find is kept.
+    def evict(self):
+        victims = heapq.nsmallest(len(self.data) - int(self.capacity * EVICT_TO),
+            [key for key, result in self.data.items() if result not in self.pinned], key=self.usage.get)
+        roots = set(self.find(r) for key in victims for r in key)
+        for key in victims:
+            del self.data[key]
+            del self.usage[key]
+            for r in key:
+                self.pairs[r].discard(key)
+        self.evictions += len(victims)
+        self.limit = max(self.capacity, len(self.data) + self.capacity - int(self.capacity * EVICT_TO))
+        if self.eviction == "lfu":
+            for key in self.usage:
+                self.usage[key] >>= 1
+        regexes = []
+        for root in roots:
+            for c in self.unequal.pop(root):
+                if c not in roots:
+                    self.unequal[c].discard(root)
+            del self.size[root]
+            regexes.extend(self.members.pop(root))
+        for r in regexes:
+            del self.parent[r]
+        keys = set()
+        for r in regexes:
+            if self.pairs[r]:
+                keys.update(self.pairs[r])
+            else:
+                del self.pairs[r]
+        for key in keys:
+            self.relate(key[0], key[1], self.data[key])
+
+    def eviction_stats(self):
+        return {"capacity": self.capacity, "policy": self.eviction, "entries": len(self.data),
+            "pinned": sum(1 for x in self.data.values() if x in self.pinned), "evictions": self.evictions}
+
+    def infer(self, r1, r2):
+        r1, r2 = canonical_regex(r1), canonical_regex(r2)
+        key = self.pair_key(r1, r2)
         if key in self.data:
+            if self.capacity is not None:
+                self.touch(key)
             return self.data[key]
+        result = self.fault_in(*key)
+        if result is not None:
+            return result
+        if r1 not in self.parent or r2 not in self.parent:
+            return None
+        a, b = self.find(r1), self.find(r2)
+        if a == b:
+            return "true"
+        if b in self.unequal[a]:
+            return "false"
+        return None
+
+    def query(self, r1, r2):
+        result = self.infer(r1, r2)
+        if result is not None:
+            self.stats.hit(result)
+            return result
+        t_start = time.monotonic()
+        raw = (r1, r2)
+        r1, r2 = canonical_regex(r1), canonical_regex(r2)
+        if self.engine == "native" and r1 in self.gold_fingerprints:
+            result = silent_native_eual_many((r1, [r2], self.gold_fingerprints[r1]))[0]
+        elif self.engine == "native":
+            result = silent_native_eual_test((r1, r2))
         else:
             result = silent_eual_test((r1, r2))
-            self.data[key] = result
-            return result
+        # "perfect" is kept for the exact string match, other canonical matches are "true"
+        if result == "perfect" and raw != (r1, r2):
+            result = "true"
+        self.record(r1, r2, result)
+        self.stats.miss(result, time.monotonic() - t_start)
+        return result
     
+    def records(self):
+        for (r1, r2), result in self.data.items():
+            yield ("put", r1, r2, result)
+        if self.index is None or self.index.mm is None:
+            return
+        # indexed pairs this process never read, streamed from the log
+        for offset, record in self.log.scan(0, self.index.covered):
+            key = (record[1], record[2])
+            if key not in self.data and self.index.points_to(key, offset):
+                yield record
+
+    # writes are appended to the log as they happen, saving only makes them durable (in the
+    # background while checkpointing). A pickled cache is written whole, no other job can have
+    # it open (see owner_lock).
     def rewrite(self):
-        with open(self.cache_file, 'wb') as f:
+        if self.log is not None:
+            if self.checkpointer is not None:
+                self.checkpointer.request()
+            else:
+                self.log.flush()
+            return
+        with open(self.cache_file + '.tmp', 'wb') as f:
             pickle.dump(self.data, f)
+        os.replace(self.cache_file + '.tmp', self.cache_file)
+
+    # lets other jobs open a pickled cache, after it was saved
+    def close(self):
+        self.stop_checkpointing()
+        if self.owner_fd is not None:
+            os.close(self.owner_fd)
+            self.owner_fd = None
+
+    # queues log writes and has a background thread write them out, see LogCheckpointer
+    def start_checkpointing(self, interval=30.0, max_pending=1000):
+        if self.log is None:
+            raise ValueError("Background checkpointing needs the log or indexed cache store")
+        self.stop_checkpointing()
+        self.checkpointer = LogCheckpointer(self.log, interval, max_pending)
+        self.checkpointer.start()
+
+    # writes out what is still queued, it is safe to call this more than once
+    def stop_checkpointing(self):
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            self.checkpointer = None
+
+    # drops overwritten records from the log
+    def compact(self):
+        if self.log is not None:
+            with self.log.locked():
+                self.refresh()
+                self.log.rewrite(self.records())
+                if self.index is not None:
+                    self.index.build(self.log, dfa_index_entry, dfa_supersedes)
+                    self.num_unindexed = 0
+
+    # compile every gold once up front, later comparisons only fingerprint the prediction
+    def precompile_golds(self, golds):
+        if self.engine != "native":
+            return
+        golds = [x for x in set(canonical_regex(x) for x in golds) if x not in self.gold_fingerprints]
+        self.gold_fingerprints.update(gold_fingerprints(golds))
+        print("Precompiled {} gold DFAs".format(len(golds)))
 
     def soft_query(self, r1, r2):
-
-        key = r1 + "DFADIV" + r2
-        if key in self.data:
-            return self.data[key]
+        result = self.infer(r1, r2)
+        if result is None:
+            self.stats.soft_miss()
         else:
-            None
+            self.stats.hit(result)
+        return result
     
     def soft_write(self, r1, r2, result):
-        key = r1 + "DFADIV" + r2
-        self.data[key] = result
+        self.stats.count(result)
+        self.record(r1, r2, result)
 
-class SynthCache(object):
+    def disk_files(self):
+        if self.log is None:
+            return [self.cache_file]
+        return [self.log.path] + ([self.index.path] if self.index is not None else [])
 
-    def __init__(self, cache_id, dataset):
+class SynthCache(object):
+    # entries hold (result, seconds) instead of a result
+    timed = False
+    # dataset -> prefix of the cache id
+    id_prefixes = [("TurkSketch", "Turk-"), ("KB13Sketch", "KB-")]
+
+    def __init__(self, cache_id, dataset, store="log", capacity=None, eviction="lru", pin_true=True):
+        if store not in CACHE_STORES:
+            raise ValueError("Unknown cache store {}".format(store))
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy {}".format(eviction))
+        self.capacity = capacity
+        self.eviction = eviction
+        # sketches consistent with the examples, which MML trains on
+        self.pinned = ["true"] if pin_true else []
         self.dataset = dataset
-        if dataset.startswith("TurkSketch"):
-            self.cache_id = "Turk-" + cache_id
-            self.cache_file = get_cache_file(self.cache_id)
-            self.timeout = 2
-            self.mode = "1"
-        if dataset.startswith("KB13Sketch"):
-            self.cache_id = "KB-" + cache_id
-            self.cache_file = get_cache_file(self.cache_id)
-            self.timeout = 5
-            self.mode = "2"
-
-        self.data = {}
+        self.mode = synth_mode(dataset)
+        self.timeout = synth_timeout(dataset)
+        self.cache_id = [prefix for name, prefix in self.id_prefixes if dataset.startswith(name)][0] + cache_id
+        self.cache_file = get_cache_file(self.cache_id)
+        # budgets (seconds) a pass runs through, a timeout cached under a smaller budget
+        # than the largest of them is not an answer and gets synthesized again
+        self.budget_schedule = [synth_timeout(dataset)]
+
+        self.log = LogStore(get_cache_log_file(self.cache_id)) if store != "pickle" else None
+        self.index = LogIndex(get_cache_index_file(self.cache_id)) if store == "indexed" else None
+        self.owner_fd = owner_lock(self.cache_file) if self.log is None else None
+        # splits dropped since the index was built
+        self.dropped = []
+        self.num_unindexed = 0
+
+        self.table = None
+        self.stats = CacheStats()
+        self.checkpointer = None
         self.load()
 
     def load(self):
+        self.table = SynthTable(self.timed, self.capacity, self.eviction, self.pinned)
+        if self.index is not None and self.log.exists():
+            self.open_index()
+            print("Indexed {} recored".format(len(self.index)))
+            return
+        if self.log is not None and self.log.exists():
+            num_records = 0
+            for record in self.log.replay():
+                self.apply(record)
+                num_records += 1
+            print("Load {} recored".format(self.num_entries()))
+            # a bounded cache only holds part of the log, rewriting it would lose the rest
+            if num_records > 2 * self.num_entries() and self.table.evictions == 0:
+                self.compact()
+            return
         if not os.path.isfile(self.cache_file):
-            self.data = {}
+            return
+        for record in self.read_pickle():
+            self.apply(record)
+        print("Load {} recored".format(self.num_entries()))
+        # a bounded cache that evicted while loading leaves the migration to a later run
+        if self.log is not None and self.table.evictions == 0:
+            print("Migrating {} to {}".format(self.cache_file, self.log.path))
+            self.compact()
+
+    # the records of the pickled cache file
+    def read_pickle(self):
+        return read_synth_pickle(self.cache_file, self.dataset)
+
+    # applies a record written by this or another process
+    def apply(self, record):
+        if record[0] == "put":
+            self.absorb(*record[1:], persist=False)
         else:
-            with open(self.cache_file, 'rb') as f:
-                self.data = pickle.load(f)
-            print("Load {} recored".format(len(self.data)))
-
+            self.clean_split(record[1], persist=False)
+
+    # results other processes appended to the shared log since the last refresh
+    def refresh(self):
+        if self.index is not None and self.index.mm is not None and self.log.replaced():
+            # another process compacted the log and indexed it again
+            self.open_index()
+            return
+        if self.log is not None:
+            for record in self.log.read_new():
+                self.apply(record)
+
+    # Maps the index, rebuilding it when it is missing, stale or covers too little of the
+    # log, and replays the records appended after it. Entries are read from the log into the
+    # table as they are asked for.
+    def open_index(self):
+        with self.log.locked():
+            if not self.index.open() or not self.index.valid_for(self.log) \
+                    or self.log.size() - self.index.covered > self.index.covered // 4:
+                self.index.build(self.log, synth_index_entry, synth_supersedes)
+            self.log.skip_to(self.index.covered)
+            self.dropped = []
+            self.num_unindexed = 0
+        self.refresh()
+
+    # (result, budget) of an indexed entry read into the table, None if it is not indexed
+    def fault_in(self, key, sketch):
+        if self.index is None or any(key.startswith(split) for split in self.dropped):
+            return None
+        for offset, _ in self.index.candidates((key, sketch)):
+            record = self.log.read_at(offset)
+            if (record[1], record[2]) == (key, sketch):
+                self.table.put(key, sketch, record[3], record[4])
+                return record[3], record[4]
+        return None
+
+    # with an index, entries written since it was built are counted once per write
+    def num_entries(self):
+        if self.index is not None:
+            return len(self.index) + self.num_unindexed
+        return len(self.table)
+
+    def eviction_stats(self):
+        return {"capacity": self.capacity, "policy": self.eviction, "entries": len(self.table),
+            "pinned": self.table.num_pinned(), "evictions": self.table.evictions}
+
+    # (key, sketch, result, budget) of every entry, results of a TimedCache are (result, seconds)
+    def items(self):
+        for _, key, sketch, result, budget in self.records():
+            yield key, sketch, result, budget
+
+    def records(self):
+        for key, sketch, result, budget in self.table.items():
+            yield ("put", key, sketch, result, budget)
+        if self.index is None or self.index.mm is None:
+            return
+        # indexed entries this process never read, streamed from the log
+        for offset, record in self.log.scan(0, self.index.covered):
+            if record[0] != "put" or self.table.row(record[1], record[2]) is not None:
+                continue
+            if not any(record[1].startswith(split) for split in self.dropped) \
+                    and self.index.points_to((record[1], record[2]), offset):
+                yield record
+
+    # writes are appended to the log as they happen, saving only makes them durable (in the
+    # background while checkpointing). A pickled cache is written whole, no other job can have
+    # it open (see owner_lock).
     def rewrite(self):
-            with open(self.cache_file, 'wb') as f:
-                pickle.dump(self.data, f)
-
-    def run_synth(self, split, id, sketch):
-
-        # java -Djava.library.path=external/lib -cp external/resnax.jar:external/lib/* -ea resnax.Main 1 $1 $2 $3
-        cmd = ["java", "-Djava.library.path=external/lib", "-cp", "external/resnax.jar:external/lib/*", "-ea", "resnax.Main", self.mode, split, str(id), sketch]
-        try:
-            out = str(subprocess.check_output(cmd, stderr=subprocess.DEVNULL, timeout=self.timeout))
-            if "true" in out:
-                result = "true"
-            elif "false" in out:
-                result = "false"
-            elif "wrong" in out:
-                result = "wrong"
-            elif "null" in out:
-                result = "null"
-            elif "empty" in out:
-                result = "empty"
-        except subprocess.TimeoutExpired:
-            result = "timeout"
-        except subprocess.CalledProcessError:
-            result = "wrong"
-        except ValueError:
-            result = "wrong"
-            print("Value Error", split, id, sketch)
-            print("Value Error!!!!!!", split, id, sketch, file=sys.stderr)
-
+        if self.log is not None:
+            if self.checkpointer is not None:
+                self.checkpointer.request()
+            else:
+                self.log.flush()
+            return
+        data, budgets = self.table.to_dicts()
+        with open(self.cache_file + '.tmp', 'wb') as f:
+            pickle.dump({"results": data, "budgets": budgets}, f)
+        os.replace(self.cache_file + '.tmp', self.cache_file)
+
+    # lets other jobs open a pickled cache, after it was saved
+    def close(self):
+        self.stop_checkpointing()
+        if self.owner_fd is not None:
+            os.close(self.owner_fd)
+            self.owner_fd = None
+
+    # queues log writes and has a background thread write them out, see LogCheckpointer
+    def start_checkpointing(self, interval=30.0, max_pending=1000):
+        if self.log is None:
+            raise ValueError("Background checkpointing needs the log or indexed cache store")
+        self.stop_checkpointing()
+        self.checkpointer = LogCheckpointer(self.log, interval, max_pending)
+        self.checkpointer.start()
+
+    # writes out what is still queued, it is safe to call this more than once
+    def stop_checkpointing(self):
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            self.checkpointer = None
+
+    # drops overwritten and deleted records from the log
+    def compact(self):
+        if self.log is not None:
+            with self.log.locked():
+                self.refresh()
+                self.log.rewrite(self.records())
+                if self.index is not None:
+                    self.index.build(self.log, synth_index_entry, synth_supersedes)
+                    self.dropped = []
+                    self.num_unindexed = 0
+
+    def run_synth(self, split, id, sketch, budget=None):
+        return run_synthesizer(self.mode, split, id, sketch, self.timeout if budget is None else budget)
+
+    def clean_split(self, split, persist=True):
+        self.table.drop_prefix(split)
+        if self.index is not None:
+            self.dropped.append(split)
+        if persist and self.log is not None:
+            self.log.append(("drop", split))
+
+    def is_timeout(self, result):
+        return result == "timeout"
+
+    def max_budget(self):
+        return max(self.budget_schedule)
+
+    # budget the cached result was computed under, None if there is none
+    def budget_of(self, split, id, sketch):
+        entry = self.table.get(split + str(id), canonical_sketch(sketch))
+        return None if entry is None else entry[1]
+
+    # a cached timeout only stands if it was computed under at least the budget asked for
+    def lookup(self, key, sketch, budget):
+        entry = self.table.get(key, sketch)
+        if entry is None:
+            entry = self.fault_in(key, sketch)
+        if entry is None:
+            return None
+        result, cached_budget = entry
+        if self.is_timeout(result) and budget > cached_budget:
+            return None
         return result
 
-    def clean_split(self, split):
-        for k in list(self.data.keys()):
-            if k.startswith(split):
-                del self.data[k]
-
-    def query(self, split, id, sketch):
-
+    # keeps the better of the cached and the given result: a decided result or a timeout
+    # under a larger budget replaces a timeout, a decided result is never replaced
+    def absorb(self, key, sketch, result, budget, persist=True):
+        current = self.lookup(key, sketch, budget)
+        if current is None or (self.is_timeout(current) and not self.is_timeout(result)):
+            self.store(key, sketch, result, budget, persist)
+
+    def store(self, key, sketch, result, budget, persist=True):
+        if persist and self.index is not None and self.table.row(key, sketch) is None \
+                and self.fault_in(key, sketch) is None:
+            self.num_unindexed += 1
+        self.table.put(key, sketch, result, budget)
+        if persist and self.log is not None:
+            self.log.append(("put", key, sketch, result, budget))
+
+    def query(self, split, id, sketch, budget=None):
+        budget = self.max_budget() if budget is None else budget
+        sketch = canonical_sketch(sketch)
         key = split + str(id)
-        if key in self.data:
-            vars = self.data[key]
-            if sketch in vars:
-                # get result
-                return vars[sketch]
-            else:
-                result = self.run_synth(split, id, sketch)
-                self.data[key][sketch] = result
-                return result
-        else:
-            self.data[key] = {}
-            result = self.run_synth(split, id, sketch)
-            self.data[key][sketch] = result
+        result = self.lookup(key, sketch, budget)
+        if result is not None:
+            self.stats.hit(result)
             return result
+        t_start = time.monotonic()
+        result = self.run_synth(split, id, sketch, budget)
+        self.store(key, sketch, result, budget)
+        self.stats.miss(result, time.monotonic() - t_start)
+        return result
 
     def merge(self, src_cache):
-        for key in src_cache.data:
-            
-            if key not in self.data:
-                self.data[key] = {}
-
-            src_sketches = src_cache.data[key]
-
-            for var in src_sketches:
-                if var not in self.data[key]:
-                    self.data[key][var] = src_sketches[var]
-
-    def soft_query(self, split, id, sketch):
-
-        key = split + str(id)
-        if key in self.data:
-            vars = self.data[key]
-            if sketch in vars:
-                # get result
-                return vars[sketch]
-            else:
-                return None
+        for _, key, sketch, result, budget in src_cache.records():
+            self.absorb(key, canonical_sketch(sketch), result, budget)
+
+    def soft_query(self, split, id, sketch, budget=None):
+        budget = self.max_budget() if budget is None else budget
+        result = self.lookup(split + str(id), canonical_sketch(sketch), budget)
+        if result is None:
+            self.stats.soft_miss()
         else:
-            self.data[key] = {}
-            return None
+            self.stats.hit(result)
+        return result
     
-    def soft_write(self, split, id, sketch, result):
-        key = split + str(id)
-        self.data[key][sketch] = result
+    def soft_write(self, split, id, sketch, result, budget=None):
+        budget = self.max_budget() if budget is None else budget
+        self.stats.count(result)
+        self.store(split + str(id), canonical_sketch(sketch), result, budget)
 
+    def disk_files(self):
+        if self.log is None:
+            return [self.cache_file]
+        return [self.log.path] + ([self.index.path] if self.index is not None else [])
 
-class TimedCache(SynthCache):
 
-    def __init__(self, cache_id, dataset):
-        self.dataset = dataset
-        if dataset.startswith("TurkSketch"):
-            self.cache_id = "TMTurk-" + cache_id
-            self.cache_file = get_cache_file(self.cache_id)
-            self.timeout = 2
-            self.mode = "1"
-        if dataset.startswith("KB13Sketch"):
-            self.cache_id = "TMKB-" + cache_id
-            self.cache_file = get_cache_file(self.cache_id)
-            self.timeout = 5
-            self.mode = "2"
-
-        self.data = {}
-        self.load()
+class TimedCache(SynthCache):
+    timed = True
+    id_prefixes = [("TurkSketch", "TMTurk-"), ("KB13Sketch", "TMKB-")]
 
-    def run_synth(self, split, id, sketch):
+    def run_synth(self, split, id, sketch, budget=None):
         t_start = time.monotonic()
-        # java -Djava.library.path=external/lib -cp external/resnax.jar:external/lib/* -ea resnax.Main 1 $1 $2 $3
-        cmd = ["java", "-Djava.library.path=external/lib", "-cp", "external/resnax.jar:external/lib/*", "-ea", "resnax.Main", self.mode, split, str(id), sketch]
-        try:
-            out = str(subprocess.check_output(cmd, stderr=subprocess.DEVNULL, timeout=self.timeout))
-            if "true" in out:
-                result = "true"
-            elif "false" in out:
-                result = "false"
-            elif "wrong" in out:
-                result = "wrong"
-            elif "null" in out:
-                result = "null"
-            elif "empty" in out:
-                result = "empty"
-        except subprocess.TimeoutExpired:
-            result = "timeout"
-        except subprocess.CalledProcessError:
-            result = "wrong"
-        except ValueError:
-            result = "wrong"
-            print("Value Error", split, id, sketch)
-            print("Value Error!!!!!!", split, id, sketch, file=sys.stderr)
-
+        result = run_synthesizer(self.mode, split, id, sketch, self.timeout if budget is None else budget)
         return result, (time.monotonic() - t_start)
 
-    def timed_query(self, split, id, sketch):
-        return super().query(split, id, sketch)
+    def is_timeout(self, result):
+        return result[0] == "timeout"
 
-    def query(self, split, id, sketch):
-        return super().query(split, id, sketch)[0]
+    def timed_query(self, split, id, sketch, budget=None):
+        return super().query(split, id, sketch, budget)
 
-    def timed_soft_query(self, split, id, sketch):
-        return super().soft_query(split, id, sketch)
+    def query(self, split, id, sketch, budget=None):
+        return super().query(split, id, sketch, budget)[0]
 
-    def soft_query(self, split, id, sketch):
-        return super().soft_query(split, id, sketch)[0]
+    def timed_soft_query(self, split, id, sketch, budget=None):
+        return super().soft_query(split, id, sketch, budget)
 
-    def soft_write(self, split, id, sketch, result):
+    def soft_query(self, split, id, sketch, budget=None):
+        result = super().soft_query(split, id, sketch, budget)
+        return None if result is None else result[0]
+
+    def soft_write(self, split, id, sketch, result, budget=None):
         assert(len(result) == 2)
-        key = split + str(id)
-        self.data[key][sketch] = result
+        super().soft_write(split, id, sketch, result, budget)
@@ -0,0 +1,104 @@
+# Counters of an oracle cache: hits, misses (query ran the oracle itself), soft misses (soft_query
+# came back empty and the caller ran the oracle), oracle calls saved because the candidate did
+# not parse or was predicted to time out, how often each result was answered and a histogram of
+# how long the oracle took per miss. Reported as one JSON line per epoch and run.
+import os
+import json
+
+# upper bounds in seconds of the miss latency buckets, 1ms doubling up to ~2 minutes; the last
+# bucket takes everything above
+LATENCY_BUCKETS = [0.001 * 2 ** k for k in range(18)]
+
+class CacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.soft_misses = 0
+        # soft misses answered by the local syntax check instead of the oracle
+        self.malformed = 0
+        # soft misses the cost model predicted to time out, answered "timeout" without the oracle
+        self.skipped = 0
+        # result class -> answers, from hits and from results written after a miss
+        self.results = {}
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.miss_seconds = 0.0
+
+    def count(self, result):
+        # TimedCache results are (result, seconds)
+        result = result[0] if isinstance(result, tuple) else result
+        self.results[result] = self.results.get(result, 0) + 1
+
+    def hit(self, result):
+        self.hits += 1
+        self.count(result)
+
+    def miss(self, result, seconds):
+        self.misses += 1
+        self.count(result)
+        self.record_latency(seconds)
+
+    def soft_miss(self):
+        self.soft_misses += 1
+
+    def saved_malformed(self, count):
+        self.malformed += count
+
+    def skipped_timeouts(self, count):
+        self.skipped += count
+
+    def record_latency(self, seconds):
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.latency[bucket] += 1
+        self.miss_seconds += seconds
+
+    def record_latencies(self, seconds):
+        for x in seconds:
+            self.record_latency(x)
+
+    def snapshot(self):
+        return {"hits": self.hits, "misses": self.misses, "soft_misses": self.soft_misses,
+            "malformed": self.malformed, "skipped": self.skipped, "results": dict(self.results),
+            "latency": list(self.latency), "miss_seconds": self.miss_seconds}
+
+    # counts since an earlier snapshot, all of them without one
+    def since(self, mark=None):
+        now = self.snapshot()
+        if mark is None:
+            return now
+        return {"hits": now["hits"] - mark["hits"], "misses": now["misses"] - mark["misses"],
+            "soft_misses": now["soft_misses"] - mark["soft_misses"],
+            "malformed": now["malformed"] - mark["malformed"],
+            "skipped": now["skipped"] - mark["skipped"],
+            "results": dict((k, v - mark["results"].get(k, 0)) for k, v in now["results"].items()
+                if v > mark["results"].get(k, 0)),
+            "latency": [a - b for a, b in zip(now["latency"], mark["latency"])],
+            "miss_seconds": now["miss_seconds"] - mark["miss_seconds"]}
+
+def disk_bytes(paths):
+    return sum(os.path.getsize(x) for x in paths if os.path.isfile(x))
+
+# one JSON line with the counts of cache since mark, scope says what they cover (an epoch, the
+# validation pass, a run) and fields are added as they are, e.g. epoch=3
+def cache_stats_json(cache, scope, mark=None, **fields):
+    counts = cache.stats.since(mark)
+    lookups = counts["hits"] + counts["misses"] + counts["soft_misses"]
+    report = {"cache_stats": scope, "cache_id": cache.cache_id}
+    report.update(fields)
+    report.update({
+        "hits": counts["hits"],
+        "misses": counts["misses"],
+        "soft_misses": counts["soft_misses"],
+        "malformed": counts["malformed"],
+        "skipped": counts["skipped"],
+        "hit_rate": counts["hits"] / lookups if lookups else None,
+        "results": counts["results"],
+        "miss_latency": {"bucket_seconds": LATENCY_BUCKETS, "counts": counts["latency"],
+            "total_seconds": round(counts["miss_seconds"], 3)},
+        "entries": cache.num_entries(),
+        "bytes_on_disk": disk_bytes(cache.disk_files()),
+    })
+    if cache.capacity is not None:
+        report["eviction"] = cache.eviction_stats()
+    return json.dumps(report)
@@ -0,0 +1,444 @@
+# Append-only record log backing the oracle caches (caches/<cache_id>.log). Every cache write
+# is one record, so saving costs O(new records) instead of re-pickling the whole cache, and
+# loading streams records instead of unpickling one large object.
+# A record is a header (payload length, crc32 of the payload) followed by a pickled tuple.
+# A crash can only leave a torn record at the end of the log; it is detected by its length or
+# checksum and cut off on the next load.
+import os
+import sys
+import mmap
+import pickle
+import struct
+import hashlib
+import zlib
+import fcntl
+import atexit
+import signal
+import threading
+from contextlib import contextmanager
+
+RECORD_HEADER = struct.Struct('<II')
+
+def encode_record(record):
+    payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+# (record, offset of the next record) for every intact record of f from its current position
+def read_records(f):
+    while True:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, crc = RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        yield pickle.loads(payload), f.tell()
+
+# A pickled cache is only read when it is opened and written whole when it is saved, so results
+# of other jobs could not be seen during a run and a save would overwrite them. The job that
+# opens it takes an flock on <path>.lock until it closes the cache; another job opening the same
+# cache fails instead. Returns the locked descriptor, close it to release.
+def owner_lock(path):
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        raise ValueError("{} is open in another job, caches shared by several jobs need "
+            "--cache_store log or indexed".format(path))
+    return fd
+
+# Several processes (training and eval jobs with the same --cache_id) can share one log.
+# Every record goes out in a single write to an O_APPEND descriptor under an flock on
+# <log>.lock, so records of different writers never interleave, and each process reads the
+# records the others appended with read_new. A compaction replaces the file, the others
+# notice the new inode and read it again from the start.
+class LogStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.inode = None
+        # how far this process has read the log
+        self.offset = 0
+        self.lock_fd = None
+        self.lock_depth = 0
+        # the flock is per process, threads of one process (see LogCheckpointer) take this first
+        self.thread_lock = threading.RLock()
+        # records waiting for a background checkpoint, None while appends are written through
+        self.pending = None
+        self.pending_lock = threading.Lock()
+        self.max_pending = None
+        self.pending_full = None
+
+    @contextmanager
+    def locked(self):
+        with self.thread_lock:
+            if self.lock_fd is None:
+                self.lock_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+            if self.lock_depth == 0:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def size(self):
+        return os.path.getsize(self.path) if self.exists() else 0
+
+    def open(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self.inode = os.fstat(self.fd).st_ino
+        self.offset = 0
+
+    def replaced(self):
+        return self.fd is None or not self.exists() or os.stat(self.path).st_ino != self.inode
+
+    # records appended since the last read, by this or any other process, streamed under the
+    # lock; the first call reads the whole log. A torn record at the end can only be left by
+    # a crashed writer and is cut off.
+    def read_new(self):
+        with self.locked():
+            if not self.exists():
+                return
+            if self.replaced():
+                self.open()
+            if os.fstat(self.fd).st_size == self.offset:
+                return
+            end = self.offset
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                for record, end in read_records(f):
+                    yield record
+            if end < os.fstat(self.fd).st_size:
+                print("Dropping a torn record at the end of {}".format(self.path), file=sys.stderr)
+                os.ftruncate(self.fd, end)
+            self.offset = end
+
+    def replay(self):
+        return self.read_new()
+
+    # continues read_new from offset instead of the start, e.g. past the part an index covers
+    def skip_to(self, offset):
+        if self.replaced():
+            self.open()
+        self.offset = offset
+
+    # (offset, record) for the intact records in [start, end), read through a separate handle
+    def scan(self, start=0, end=None):
+        if not self.exists():
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            offset = start
+            for record, next_offset in read_records(f):
+                if end is not None and offset >= end:
+                    return
+                yield offset, record
+                offset = next_offset
+
+    # the record starting at offset
+    def read_at(self, offset):
+        with self.thread_lock:
+            if self.fd is None:
+                self.skip_to(0)
+            header = os.pread(self.fd, RECORD_HEADER.size, offset)
+            length, crc = RECORD_HEADER.unpack(header)
+            payload = os.pread(self.fd, length, offset + RECORD_HEADER.size)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            raise IOError("Corrupt record at {} of {}".format(offset, self.path))
+        return pickle.loads(payload)
+
+    def append(self, record):
+        if self.pending is not None:
+            with self.pending_lock:
+                if self.pending is not None:
+                    self.pending.append(record)
+                    if len(self.pending) >= self.max_pending:
+                        self.pending_full.set()
+                    return
+        with self.locked():
+            if self.replaced():
+                self.open()
+            os.write(self.fd, encode_record(record))
+
+    # appends records in writes of about chunk bytes, for bulk loads
+    def append_many(self, records, chunk=1 << 20):
+        with self.locked():
+            if self.replaced():
+                self.open()
+            buf = []
+            size = 0
+            for record in records:
+                buf.append(encode_record(record))
+                size += len(buf[-1])
+                if size >= chunk:
+                    os.write(self.fd, b''.join(buf))
+                    buf, size = [], 0
+            if buf:
+                os.write(self.fd, b''.join(buf))
+
+    # makes the appended records durable
+    def flush(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+
+    # From now on append only queues records, flush_pending writes them; full is set once
+    # max_pending records are queued.
+    def start_buffering(self, max_pending, full):
+        with self.pending_lock:
+            self.pending = [] if self.pending is None else self.pending
+            self.max_pending = max_pending
+            self.pending_full = full
+
+    def stop_buffering(self):
+        with self.pending_lock:
+            records, self.pending = self.pending, None
+        if records:
+            self.append_many(records)
+        self.flush()
+
+    # writes the queued records and makes them durable; they are queued again if that fails
+    def flush_pending(self):
+        with self.locked():
+            with self.pending_lock:
+                if not self.pending:
+                    return 0
+                records, self.pending = self.pending, []
+            try:
+                self.append_many(records)
+                self.flush()
+            except BaseException:
+                with self.pending_lock:
+                    self.pending[:0] = records
+                raise
+            return len(records)
+
+    # replaces the log with the given records, e.g. to drop overwritten entries. Callers that
+    # share the log read_new under the same lock first, so no other process's record is lost.
+    def rewrite(self, records):
+        with self.locked():
+            # queued records go out first, records read from the log then include them
+            self.flush_pending()
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for record in records:
+                    f.write(encode_record(record))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.open()
+            self.offset = os.fstat(self.fd).st_size
+
+    def close(self):
+        if self.fd is not None:
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
+
+# On-disk hash index over a log (caches/<cache_id>.idx), so a cache opens without replaying
+# its log. The index is an open-addressing table of (key hash, record offset, caller data)
+# slots that is mmap'd read-only; a lookup touches one or two pages of it and reads one record
+# of the log, so a process only ever faults in the entries it asks for. The index covers the
+# log up to a given length, records appended after that are replayed on open as usual.
+INDEX_MAGIC = b'DSKIDX01'
+# magic, inode of the indexed log, log bytes covered, number of slots, number of entries
+INDEX_HEADER = struct.Struct('<8sQQQQ')
+# key hash, record offset + 1 (0 marks an empty slot), caller data
+INDEX_SLOT = struct.Struct('<QQI4x')
+
+# 64 bit hash of a key given as a tuple of strings
+def key_hash(parts):
+    digest = hashlib.blake2b('\0'.join(parts).encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+class LogIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+        self.inode = None
+        self.covered = 0
+        self.num_slots = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def open(self):
+        self.close()
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) < INDEX_HEADER.size:
+                return False
+            magic, self.inode, self.covered, self.num_slots, self.count = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC:
+                return False
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return True
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    # whether the index was built for the log file currently at log.path
+    def valid_for(self, log):
+        return self.mm is not None and log.exists() and os.stat(log.path).st_ino == self.inode \
+            and self.covered <= log.size()
+
+    def slot(self, mm, i):
+        return INDEX_SLOT.unpack_from(mm, INDEX_HEADER.size + i * INDEX_SLOT.size)
+
+    # (offset, data) of the slots whose key hashes like parts; callers check the record
+    def candidates(self, parts):
+        if self.mm is None or self.num_slots == 0:
+            return
+        h = key_hash(parts)
+        i = h & (self.num_slots - 1)
+        while True:
+            slot_hash, offset, data = self.slot(self.mm, i)
+            if offset == 0:
+                return
+            if slot_hash == h:
+                yield offset - 1, data
+            i = (i + 1) & (self.num_slots - 1)
+
+    # whether offset holds the indexed record for the key parts
+    def points_to(self, parts, offset):
+        return any(x == offset for x, _ in self.candidates(parts))
+
+    # Builds the index for log in two streaming passes, under the log's lock. entry(record)
+    # gives (key parts, data) for a put record and None for any other; a ("drop", prefix)
+    # record removes the earlier entries whose key starts with prefix. When a key is put
+    # again, supersedes(old data, new data) tells whether the new record replaces the old.
+    def build(self, log, entry, supersedes):
+        with log.locked():
+            inode = os.stat(log.path).st_ino
+            covered = log.size()
+            num_puts = 0
+            drops = []
+            for offset, record in log.scan(0, covered):
+                if record[0] == "drop":
+                    drops.append((record[1], offset))
+                elif entry(record) is not None:
+                    num_puts += 1
+            num_slots = 16
+            while num_slots < 2 * num_puts:
+                num_slots *= 2
+
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb+') as f:
+                f.truncate(INDEX_HEADER.size + num_slots * INDEX_SLOT.size)
+                mm = mmap.mmap(f.fileno(), 0)
+                count = 0
+                for offset, record in log.scan(0, covered):
+                    described = entry(record)
+                    if described is None:
+                        continue
+                    parts, data = described
+                    if any(parts[0].startswith(prefix) and offset < at for prefix, at in drops):
+                        continue
+                    h = key_hash(parts)
+                    i = h & (num_slots - 1)
+                    while True:
+                        slot_hash, slot_offset, slot_data = self.slot(mm, i)
+                        if slot_offset == 0:
+                            count += 1
+                            break
+                        if slot_hash == h:
+                            if not supersedes(slot_data, data):
+                                i = None
+                            break
+                        i = (i + 1) & (num_slots - 1)
+                    if i is not None:
+                        INDEX_SLOT.pack_into(mm, INDEX_HEADER.size + i * INDEX_SLOT.size, h, offset + 1, data)
+                INDEX_HEADER.pack_into(mm, 0, INDEX_MAGIC, inode, covered, num_slots, count)
+                mm.flush()
+                mm.close()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.open()
+
+# Writes the records a LogStore queues in a background thread, every interval seconds or as
+# soon as max_pending records are waiting, so appends never wait on the disk and a crash loses
+# at most that much work. stop writes out the rest; it also runs at exit, and SIGTERM/SIGHUP
+# are turned into a normal exit so it runs then too.
+class LogCheckpointer(object):
+    def __init__(self, log, interval=30.0, max_pending=1000):
+        self.log = log
+        self.interval = interval
+        self.max_pending = max_pending
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.num_checkpoints = 0
+
+    def start(self):
+        self.log.start_buffering(self.max_pending, self.wake)
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="checkpoint-" + self.log.path, daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        exit_on_signals()
+
+    def run(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                if self.log.flush_pending():
+                    self.num_checkpoints += 1
+            except Exception as err:
+                print("Checkpoint of {} failed: {}".format(self.log.path, err), file=sys.stderr)
+
+    # asks for a checkpoint without waiting for it
+    def request(self):
+        self.wake.set()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+        self.thread = None
+        self.log.stop_buffering()
+        atexit.unregister(self.stop)
+
+def _exit_on_signal(signum, frame):
+    sys.exit(128 + signum)
+
+def exit_on_signals():
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for signum in [signal.SIGTERM, signal.SIGHUP]:
+        if signal.getsignal(signum) == signal.SIG_DFL:
+            signal.signal(signum, _exit_on_signal)
+
+# Drops overwritten and dropped records from a log without holding its entries in memory:
+# the index is built first, then only the records it points to are copied, and the index is
+# built again for the new log.
+def compact_log(log, index, entry, supersedes):
+    with log.locked():
+        index.build(log, entry, supersedes)
+
+        def live_records():
+            for offset, record in log.scan(0, index.covered):
+                described = entry(record)
+                if described is not None and index.points_to(described[0], offset):
+                    yield record
+
+        log.rewrite(live_records())
+        index.build(log, entry, supersedes)
+
+CACHE_STORES = ["log", "pickle", "indexed"]
@@ -0,0 +1,207 @@
+# Compact in-memory table behind SynthCache and TimedCache. With millions of cached sketches a
+# dict of example key -> dict of sketch -> result string spends most of its memory on Python
+# object overhead. Here example keys and sketch strings are interned to ints (a sketch shared
+# by many examples is held once), and an entry is one row of array columns: a one byte result
+# code, a float32 budget and, in a timed table, a float32 time in seconds.
+import heapq
+from array import array
+
+# result strings of the synthesizer and the DFA oracle, a result is stored as its index
+RESULT_CODES = ["true", "false", "wrong", "null", "empty", "timeout", "perfect"]
+RESULT_INDEX = dict((result, code) for code, result in enumerate(RESULT_CODES))
+
+# A bounded cache that outgrows its capacity evicts its least recently (lru) or least
+# frequently (lfu) used entries down to EVICT_TO of the capacity, so the cost of picking
+# victims is paid once per many inserts. Pinned entries are never evicted.
+EVICTION_POLICIES = ["lru", "lfu"]
+EVICT_TO = 0.9
+
+# Values interned with acquire are counted and forgotten once every user released them, so a
+# bounded cache does not keep the strings of evicted entries; their ids are reused. Values
+# interned with intern are kept for good.
+class InternTable(object):
+    __slots__ = ["ids", "values", "refs", "free"]
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+        self.refs = array('I')
+        # ids of released values
+        self.free = []
+
+    def intern(self, value):
+        id = self.ids.get(value)
+        if id is None:
+            id = len(self.values)
+            self.ids[value] = id
+            self.values.append(value)
+            self.refs.append(0)
+        return id
+
+    def acquire(self, value):
+        id = self.ids.get(value)
+        if id is None:
+            if self.free:
+                id = self.free.pop()
+                self.values[id] = value
+            else:
+                id = len(self.values)
+                self.values.append(value)
+                self.refs.append(0)
+            self.ids[value] = id
+        self.refs[id] += 1
+        return id
+
+    def release(self, id):
+        self.refs[id] -= 1
+        if self.refs[id] == 0:
+            del self.ids[self.values[id]]
+            self.values[id] = None
+            self.free.append(id)
+
+    # id of an interned value, None if it was never interned
+    def get(self, value):
+        return self.ids.get(value)
+
+    def __getitem__(self, id):
+        return self.values[id]
+
+    # ids handed out, released ones included
+    def __len__(self):
+        return len(self.values)
+
+class SynthTable(object):
+    # entry values are result strings, or (result, seconds) pairs in a timed table. With a
+    # capacity, entries with a result in pinned are kept whatever their use.
+    def __init__(self, timed=False, capacity=None, policy="lru", pinned=()):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy {}".format(policy))
+        self.timed = timed
+        self.capacity = capacity
+        self.policy = policy
+        self.pinned = bytes(RESULT_INDEX[x] for x in pinned)
+        # last use (lru) or number of uses (lfu) of every row
+        self.usage = array('Q')
+        self.clock = 0
+        self.evictions = 0
+        # size that triggers the next eviction, above the capacity when pinned entries fill it
+        self.limit = capacity
+        self.keys = InternTable()
+        self.sketches = InternTable()
+        # key id << 32 | sketch id -> row
+        self.rows = {}
+        self.results = bytearray()
+        self.budgets = array('f')
+        self.times = array('f')
+        # rows of dropped entries, reused by the next puts
+        self.free = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, entry):
+        return self.row(*entry) is not None
+
+    def row(self, key, sketch):
+        key_id = self.keys.get(key)
+        sketch_id = self.sketches.get(sketch)
+        if key_id is None or sketch_id is None:
+            return None
+        return self.rows.get(key_id << 32 | sketch_id)
+
+    def touch(self, row):
+        if self.policy == "lru":
+            self.clock += 1
+            self.usage[row] = self.clock
+        else:
+            self.usage[row] += 1
+
+    def num_pinned(self):
+        return sum(1 for row in self.rows.values() if self.results[row] in self.pinned)
+
+    def evict(self):
+        victims = heapq.nsmallest(len(self.rows) - int(self.capacity * EVICT_TO),
+            [entry for entry, row in self.rows.items() if self.results[row] not in self.pinned],
+            key=lambda entry: self.usage[self.rows[entry]])
+        for entry in victims:
+            self.remove(entry)
+        self.evictions += len(victims)
+        self.limit = max(self.capacity, len(self.rows) + self.capacity - int(self.capacity * EVICT_TO))
+        if self.policy == "lfu":
+            # ages the counts, so entries that were popular long ago can go too
+            for row in self.rows.values():
+                self.usage[row] >>= 1
+
+    def value(self, row):
+        result = RESULT_CODES[self.results[row]]
+        if self.timed:
+            return result, float(self.times[row])
+        return result
+
+    # budgets are whole milliseconds, rounding undoes the float32 error (1.3 is stored as 1.2999...)
+    def budget(self, row):
+        return round(float(self.budgets[row]), 3)
+
+    # (value, budget) of an entry, None if there is none
+    def get(self, key, sketch):
+        row = self.row(key, sketch)
+        if row is None:
+            return None
+        if self.capacity is not None:
+            self.touch(row)
+        return self.value(row), self.budget(row)
+
+    def put(self, key, sketch, value, budget):
+        result, seconds = value if self.timed else (value, 0.0)
+        code = RESULT_INDEX.get(result)
+        if code is None:
+            raise ValueError("Unknown oracle result {}".format(result))
+        row = self.row(key, sketch)
+        if row is None:
+            entry = self.keys.acquire(key) << 32 | self.sketches.acquire(sketch)
+            if self.free:
+                row = self.free.pop()
+            else:
+                row = len(self.results)
+                self.results.append(0)
+                self.budgets.append(0.0)
+                self.usage.append(0)
+                if self.timed:
+                    self.times.append(0.0)
+            self.rows[entry] = row
+            self.usage[row] = 0
+        self.results[row] = code
+        self.budgets[row] = budget
+        if self.timed:
+            self.times[row] = seconds
+        if self.capacity is not None:
+            self.touch(row)
+            if len(self.rows) > self.limit:
+                self.evict()
+
+    # frees the row of an entry and releases its key and sketch
+    def remove(self, entry):
+        self.free.append(self.rows.pop(entry))
+        self.keys.release(entry >> 32)
+        self.sketches.release(entry & 0xffffffff)
+
+    # drops every entry whose example key starts with prefix, e.g. a split
+    def drop_prefix(self, prefix):
+        key_ids = set(id for key, id in self.keys.ids.items() if key.startswith(prefix))
+        if not key_ids:
+            return
+        for entry in [x for x in self.rows if x >> 32 in key_ids]:
+            self.remove(entry)
+
+    # (key, sketch, value, budget) for every entry
+    def items(self):
+        for entry, row in self.rows.items():
+            yield self.keys[entry >> 32], self.sketches[entry & 0xffffffff], self.value(row), self.budget(row)
+
+    # the nested {key: {sketch: value}} and {key: {sketch: budget}} dicts of the pickle format
+    def to_dicts(self):
+        data, budgets = {}, {}
+        for key, sketch, value, budget in self.items():
+            data.setdefault(key, {})[sketch] = value
+            budgets.setdefault(key, {})[sketch] = budget
+        return data, budgets
@@ -0,0 +1,238 @@
+# Maintenance of the oracle caches in caches/. Logs are streamed and deduplicated through an
+# on-disk index (see compact_log), so caches of several GB never have to fit in memory; only
+# the pickle format, which is one object, is read and written whole.
+#   python cache_tool.py stats Turk-cache KB-cache
+#   python cache_tool.py merge Turk-cache Turk-run1 caches/Turk-run2.pkl
+#   python cache_tool.py drop Turk-cache val test
+#   python cache_tool.py compact DFA-Turk-cache
+#   python cache_tool.py convert TMTurk-cache Turk-cache
+#   python cache_tool.py convert Turk-cache Turk-cache --format pickle
+# A cache is given by its id, the name of its files in caches/, or by the path of its .log or
+# .pkl file. The id prefix tells the layout: Turk-/KB- for SynthCache, TMTurk-/TMKB- for
+# TimedCache and DFA-<dataset>- for DFACache.
+import argparse
+import itertools
+import json
+import os
+import pickle
+import sys
+from os.path import basename, dirname, join, splitext
+from cache_store import LogStore, LogIndex, compact_log, owner_lock
+from cost_model import split_cache_key
+from SynthCache import read_dfa_pickle, read_synth_pickle, dfa_index_entry, dfa_supersedes, \
+    synth_index_entry, synth_supersedes
+
+# id prefix -> (layout, dataset)
+CACHE_KINDS = [
+    ("TMTurk-", "timed", "TurkSketch"),
+    ("TMKB-", "timed", "KB13Sketch"),
+    ("Turk-", "synth", "TurkSketch"),
+    ("KB-", "synth", "KB13Sketch"),
+    ("DFA-", "dfa", None),
+]
+STORE_FORMATS = ["log", "indexed", "pickle"]
+
+class CacheFiles(object):
+    def __init__(self, name):
+        if name.endswith('.log') or name.endswith('.pkl'):
+            folder, self.cache_id = dirname(name), splitext(basename(name))[0]
+        else:
+            folder, self.cache_id = './caches', name
+        for prefix, kind, dataset in CACHE_KINDS:
+            if self.cache_id.startswith(prefix):
+                self.kind, self.dataset = kind, dataset
+                break
+        else:
+            raise ValueError("Cannot tell the layout of cache {}".format(self.cache_id))
+        self.log = LogStore(join(folder, self.cache_id + '.log'))
+        self.index = LogIndex(join(folder, self.cache_id + '.idx'))
+        self.pickle_path = join(folder, self.cache_id + '.pkl')
+        self.entry = dfa_index_entry if self.kind == "dfa" else synth_index_entry
+        self.supersedes = dfa_supersedes if self.kind == "dfa" else synth_supersedes
+
+    # the log when there is one, as the caches load it
+    def format(self):
+        if self.log.exists():
+            return "log"
+        if os.path.isfile(self.pickle_path):
+            return "pickle"
+        return None
+
+    def records(self):
+        if self.format() == "log":
+            for _, record in self.log.scan():
+                yield record
+        elif self.format() == "pickle":
+            if self.kind == "dfa":
+                yield from read_dfa_pickle(self.pickle_path)
+            else:
+                yield from read_synth_pickle(self.pickle_path, self.dataset)
+
+    # the log, written from the pickle first when there is only a pickle
+    def writable_log(self):
+        if self.format() == "pickle":
+            self.log.rewrite(self.records())
+        return self.log
+
+    def files(self):
+        return [x for x in [self.log.path, self.index.path, self.pickle_path] if os.path.isfile(x)]
+
+# the caches a command reads have to be there, a missing one ends the command with a message
+def existing(cache):
+    if cache.format() is None:
+        sys.exit("cache_tool.py: no log or pickle of cache {} in {}".format(cache.cache_id, dirname(cache.log.path)))
+    return cache
+
+# a record of one layout in another; a SynthCache has no timings, so they are NaN in a TimedCache
+def convert_record(record, src_kind, dst_kind):
+    if src_kind == dst_kind or record[0] != "put":
+        return record
+    if "dfa" in (src_kind, dst_kind):
+        raise ValueError("Cannot convert between {} and {} caches".format(src_kind, dst_kind))
+    _, key, sketch, result, budget = record
+    result = result[0] if dst_kind == "synth" else (result, float('nan'))
+    return ("put", key, sketch, result, budget)
+
+def converted_records(src, dst):
+    for record in src.records():
+        yield convert_record(record, src.kind, dst.kind)
+
+def stats(cache):
+    report = {"cache": cache.cache_id, "kind": cache.kind, "format": cache.format(),
+        "bytes_on_disk": dict((basename(x), os.path.getsize(x)) for x in cache.files())}
+    num_records, num_drops = 0, 0
+    results, splits = {}, {}
+
+    def count(record):
+        # TimedCache results are (result, seconds)
+        result = record[3][0] if isinstance(record[3], tuple) else record[3]
+        results[result] = results.get(result, 0) + 1
+        if cache.kind != "dfa":
+            split = split_cache_key(record[1])[0]
+            splits[split] = splits.get(split, 0) + 1
+
+    if cache.format() == "log":
+        # a throwaway index picks out the records that are still live
+        index = LogIndex(cache.index.path + '.stats')
+        index.build(cache.log, cache.entry, cache.supersedes)
+        for offset, record in cache.log.scan(0, index.covered):
+            num_records += 1
+            if record[0] == "drop":
+                num_drops += 1
+                continue
+            described = cache.entry(record)
+            if described is not None and index.points_to(described[0], offset):
+                count(record)
+        index.close()
+        os.remove(index.path)
+    else:
+        for record in cache.records():
+            num_records += 1
+            count(record)
+    report.update({"records": num_records, "drops": num_drops, "entries": sum(results.values()),
+        "results": results})
+    if cache.kind != "dfa":
+        report["splits"] = splits
+    return report
+
+def merge(dst, srcs):
+    log = dst.writable_log()
+    for src in srcs:
+        print("Merging {} into {}".format(src.cache_id, dst.cache_id))
+        log.append_many(converted_records(src, dst))
+    compact_log(log, dst.index, dst.entry, dst.supersedes)
+
+def drop(cache, splits):
+    if cache.kind == "dfa":
+        raise ValueError("DFA caches have no splits")
+    if cache.format() == "pickle":
+        # the caches read the pickle when there is no log, so it is written without the splits
+        write_pickle(cache, cache, splits)
+        return
+    log = cache.writable_log()
+    log.append_many(("drop", split) for split in splits)
+    compact_log(log, cache.index, cache.entry, cache.supersedes)
+
+def compact(cache):
+    compact_log(cache.writable_log(), cache.index, cache.entry, cache.supersedes)
+
+# dst as a pickle of src, without the splits in drops
+def write_pickle(src, dst, drops=()):
+    # fails while a job has the pickle open, it would write its own copy back when it saves
+    fd = owner_lock(dst.pickle_path)
+    try:
+        write_pickle_locked(src, dst, drops)
+    finally:
+        os.close(fd)
+
+def write_pickle_locked(src, dst, drops):
+    # later records follow the same merge rule as the log, decided on their index data
+    data, budgets, index_data = {}, {}, {}
+    for record in itertools.chain(converted_records(src, dst), [("drop", split) for split in drops]):
+        if record[0] == "drop":
+            for key in [x for x in data if x.startswith(record[1])]:
+                del data[key], budgets[key], index_data[key]
+            continue
+        parts, new = dst.entry(record)
+        if dst.kind == "dfa":
+            data[parts] = record[3]
+            continue
+        key, sketch = parts
+        old = index_data.get(key, {}).get(sketch)
+        if old is None or dst.supersedes(old, new):
+            data.setdefault(key, {})[sketch] = record[3]
+            budgets.setdefault(key, {})[sketch] = record[4]
+            index_data.setdefault(key, {})[sketch] = new
+    with open(dst.pickle_path + '.tmp', 'wb') as f:
+        pickle.dump(data if dst.kind == "dfa" else {"results": data, "budgets": budgets}, f)
+    os.replace(dst.pickle_path + '.tmp', dst.pickle_path)
+
+def convert(src, dst, store):
+    if store == "pickle":
+        write_pickle(src, dst)
+        return
+    if src.log.path != dst.log.path:
+        dst.log.rewrite(converted_records(src, dst))
+    else:
+        dst.writable_log()
+    compact_log(dst.log, dst.index, dst.entry, dst.supersedes)
+    if store == "log":
+        dst.index.close()
+        os.remove(dst.index.path)
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='cache_tool.py')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    p = commands.add_parser('stats', help='print entries, results and splits of caches as JSON')
+    p.add_argument('caches', nargs='+')
+    p = commands.add_parser('merge', help='merge caches into the first one')
+    p.add_argument('dst')
+    p.add_argument('srcs', nargs='+')
+    p = commands.add_parser('drop', help='drop the entries of splits')
+    p.add_argument('cache')
+    p.add_argument('splits', nargs='+')
+    p = commands.add_parser('compact', help='drop overwritten and dropped records of a log')
+    p.add_argument('cache')
+    p = commands.add_parser('convert', help='write a cache in another layout or format, replacing dst')
+    p.add_argument('src')
+    p.add_argument('dst')
+    p.add_argument('--format', type=str, default="log", help='storage of dst, log, indexed or pickle')
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = _parse_args()
+    if args.command == 'stats':
+        for name in args.caches:
+            print(json.dumps(stats(existing(CacheFiles(name)))))
+    elif args.command == 'merge':
+        merge(CacheFiles(args.dst), [existing(CacheFiles(x)) for x in args.srcs])
+    elif args.command == 'drop':
+        drop(existing(CacheFiles(args.cache)), args.splits)
+    elif args.command == 'compact':
+        compact(existing(CacheFiles(args.cache)))
+    elif args.command == 'convert':
+        if args.format not in STORE_FORMATS:
+            raise ValueError("Unknown cache store {}".format(args.format))
+        convert(existing(CacheFiles(args.src)), CacheFiles(args.dst), args.format)
@@ -0,0 +1,198 @@
+# Predicts how long the synthesizer takes on a (sketch, example) pair, trained on the
+# wall times TimedCache records. Used to hand sketches to the oracle cheapest first and to
+# optionally skip the ones that are predicted to time out.
+#   python cost_model.py TurkSketch --cache_id cache
+import argparse
+import math
+import os
+import pickle
+from functools import lru_cache
+from os.path import join
+import numpy as np
+from data import get_cache_file
+from grammar import parse_sketch, SketchParseError, OPERATORS
+
+EXAMPLE_DIRS = {'TurkSketch': 'turk', 'KB13Sketch': 'kb13'}
+OPERATOR_NAMES = sorted(OPERATORS)
+
+def sketch_features(sketch):
+    try:
+        node = parse_sketch(sketch)
+    except SketchParseError:
+        return [1.0] + [0.0] * (8 + len(OPERATOR_NAMES))
+    counts = dict((name, 0) for name in OPERATOR_NAMES)
+    stats = {'holes': 0, 'components': 0, 'consts': 0, 'ints': 0, 'max_int': 0, 'nodes': 0}
+
+    def walk(node, depth):
+        stats['nodes'] += 1
+        if node[0] == 'hole':
+            stats['holes'] += 1
+            stats['components'] += len(node[1])
+            children = node[1]
+        elif node[0] == 'op':
+            counts[node[1]] += 1
+            children = node[2]
+        elif node[0] == 'const':
+            stats['consts'] += 1
+            children = ()
+        else:
+            stats['ints'] += 1
+            stats['max_int'] = max(stats['max_int'], int(node[1]))
+            children = ()
+        return max([depth] + [walk(x, depth + 1) for x in children])
+
+    depth = walk(node, 1)
+    return [0.0, stats['holes'], stats['components'], depth, stats['nodes'], stats['consts'], stats['ints'],
+        stats['max_int'], len(sketch)] + [counts[name] for name in OPERATOR_NAMES]
+
+# positives, negatives and total length of the examples the synthesizer has to satisfy
+@lru_cache(maxsize=None)
+def example_features(dataset, split, id):
+    fname = join('external', 'examples', EXAMPLE_DIRS.get(dataset, ''), 'example-{}'.format(split), str(id))
+    if not os.path.isfile(fname):
+        return [0.0, 0.0, 0.0]
+    with open(fname) as f:
+        lines = f.read().split('\n')
+    pos, neg, length = 0, 0, 0
+    for line in lines[1:]:
+        if not line.strip():
+            break
+        if line.endswith(',+'):
+            pos += 1
+        elif line.endswith(',-'):
+            neg += 1
+        length += len(line)
+    return [pos, neg, length]
+
+def split_cache_key(key):
+    # cache keys are split + str(id)
+    id_start = len(key.rstrip('0123456789'))
+    return key[:id_start], key[id_start:]
+
+class CostModel(object):
+    # ridge regression on log seconds and a logistic regression on the chance of a timeout,
+    # both over standardized sketch and example features
+    def __init__(self, dataset, l2=1.0):
+        self.dataset = dataset
+        self.l2 = l2
+        self.mean = None
+        self.std = None
+        self.time_weights = None
+        self.timeout_weights = None
+        # budget the timeouts in the training data were observed under
+        self.train_budget = None
+
+    def features(self, split, id, sketch):
+        return sketch_features(sketch) + example_features(self.dataset, split, id)
+
+    def design(self, rows):
+        x = (np.asarray(rows, dtype=np.float64) - self.mean) / self.std
+        return np.hstack([x, np.ones((x.shape[0], 1))])
+
+    # samples are (split, id, sketch, result, seconds)
+    def fit(self, samples, train_budget, epochs=200, lr=0.5):
+        rows = [self.features(split, id, sketch) for split, id, sketch, _, _ in samples]
+        rows = np.asarray(rows, dtype=np.float64)
+        self.mean = rows.mean(0)
+        self.std = rows.std(0) + 1e-6
+        x = self.design(rows)
+        timeouts = np.asarray([result == "timeout" for _, _, _, result, _ in samples], dtype=np.float64)
+        # a timeout is only known to take at least the budget
+        seconds = np.asarray([max(t, train_budget) if result == "timeout" else t
+            for _, _, _, result, t in samples], dtype=np.float64)
+        y = np.log(seconds + 1e-3)
+        reg = self.l2 * np.eye(x.shape[1])
+        reg[-1, -1] = 0.0
+        self.time_weights = np.linalg.solve(x.T @ x + reg, x.T @ y)
+
+        w = np.zeros(x.shape[1])
+        for _ in range(epochs):
+            p = 1.0 / (1.0 + np.exp(-(x @ w)))
+            w -= lr * (x.T @ (p - timeouts) / len(samples) + self.l2 * w / len(samples))
+        self.timeout_weights = w
+        self.train_budget = train_budget
+        return self
+
+    def predict(self, split, to_test_pool):
+        return self.predict_rows([self.features(split, id, sketch) for id, sketch in to_test_pool])
+
+    def predict_rows(self, rows):
+        if not rows:
+            return np.zeros(0), np.zeros(0)
+        x = self.design(rows)
+        seconds = np.exp(x @ self.time_weights)
+        p_timeout = 1.0 / (1.0 + np.exp(-(x @ self.timeout_weights)))
+        return seconds, p_timeout
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self.__dict__, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        model = CostModel(state['dataset'])
+        model.__dict__.update(state)
+        return model
+
+def get_cost_model_file(timed_cache_id):
+    return get_cache_file("COST-" + timed_cache_id)
+
+# Runs run(to_tests) over to_test_pool, cheapest predicted first, and returns the results in
+# the original order. With skip_p set, candidates whose chance of timing out under a budget
+# no larger than the one the model was trained on exceeds skip_p are not run; their result
+# is None. Without a model everything is run as given.
+def run_cheapest_first(model, split, budget, to_test_pool, run, skip_p=None):
+    if model is None:
+        return run(to_test_pool)
+    seconds, p_timeout = model.predict(split, to_test_pool)
+    order = sorted(range(len(to_test_pool)), key=lambda k: seconds[k])
+    if skip_p is not None and budget <= model.train_budget:
+        order = [k for k in order if p_timeout[k] <= skip_p]
+    results = [None] * len(to_test_pool)
+    for k, result in zip(order, run([to_test_pool[k] for k in order])):
+        results[k] = result
+    return results
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='cost_model.py')
+    parser.add_argument('dataset', help='specified dataset')
+    parser.add_argument('--cache_id', type=str, default="cache", help='id of the timed cache to train on')
+    parser.add_argument('--l2', type=float, default=1.0, help='l2 regularization')
+    parser.add_argument('--heldout', type=float, default=0.1, help='fraction of samples held out for evaluation')
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    from SynthCache import TimedCache
+    args = _parse_args()
+    cache = TimedCache(args.cache_id, args.dataset)
+
+    samples = []
+    budgets = []
+    for key, sketch, (result, seconds), budget in cache.items():
+        # entries converted from a SynthCache have no timing
+        if math.isnan(seconds):
+            continue
+        split, id = split_cache_key(key)
+        samples.append((split, id, sketch, result, seconds))
+        budgets.append(budget)
+    print("{} timed samples".format(len(samples)))
+
+    rng = np.random.RandomState(0)
+    perm = rng.permutation(len(samples))
+    num_heldout = int(len(samples) * args.heldout)
+    heldout = [samples[k] for k in perm[:num_heldout]]
+    train = [samples[k] for k in perm[num_heldout:]]
+    model = CostModel(args.dataset, args.l2).fit(train, max(budgets))
+    if heldout:
+        seconds, p_timeout = model.predict_rows([model.features(split, id, sketch) for split, id, sketch, _, _ in heldout])
+        true_seconds = np.asarray([t for _, _, _, _, t in heldout])
+        true_timeouts = np.asarray([r == "timeout" for _, _, _, r, _ in heldout])
+        print("heldout mean abs error: {:.3f}s".format(np.mean(np.abs(seconds - true_seconds))))
+        print("heldout timeout acc: {:.3f}".format(np.mean((p_timeout > 0.5) == true_timeouts)))
+
+    path = get_cost_model_file(cache.cache_id)
+    model.save(path)
+    print("Saved cost model to", path)
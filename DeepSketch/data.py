@@ -54,9 +54,21 @@ def read_lines(filename):
 def get_cache_file(cache_id):
     return join('./caches', cache_id + '.pkl')
 
+def get_cache_log_file(cache_id):
+    return join('./caches', cache_id + '.log')
+
+def get_cache_index_file(cache_id):
+    return join('./caches', cache_id + '.idx')
+
 def get_model_file(dataset, model_id):
     return join('./checkpoints', dataset, model_id + '.tar')
 
+def get_decode_file(dataset, split, model_id):
+    return join('./decodes', dataset, '{}-{}.jsonl'.format(split, model_id))
+
+def get_decode_folder(dataset, split, model_id):
+    return join('./decodes', dataset, '{}-{}'.format(split, model_id))
+
 # Reads the training, dev, and test data from the corresponding files.
 def load_datasets(dataset):
     output_path = join('./datasets', dataset)
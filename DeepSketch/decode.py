@@ -11,6 +11,8 @@ from utils import *
 import math
 from os.path import join
 from gadget import *
+from sketch_automaton import make_sketch_automaton
+from derivations import DerivationWriter, DerivationFile, export_folder
 import os
 import shutil
 
@@ -29,6 +31,10 @@ def _parse_args():
     parser.add_argument('--gpu', type=str, default=None, help='gpu id')
     parser.add_argument('--seed', type=int, default=0, help='RNG seed (default = 0)')
     parser.add_argument('--beam_size', type=int, default=20, help='beam size')
+    parser.add_argument('--batch_size', type=int, default=32, help='number of examples decoded together')
+    parser.add_argument('--export_folder', default=False, action='store_true', help='also write the decodes as one file per example')
+    parser.add_argument('--grammar_mask', default=False, action='store_true', help='only decode well-formed sketches')
+    parser.add_argument('--token_scores', default=False, action='store_true', help='also store the log prob of every token')
 
     # 65 is all you need for GeoQuery
     parser.add_argument('--decoder_len_limit', type=int, default=50, help='output length limit of the decoder')
@@ -44,14 +50,10 @@ def _parse_args():
     args = parser.parse_args()
     return args
 
-def make_input_tensor(exs, reverse_input):
-    x = np.array(exs.x_indexed)
-    len_x = len(exs.x_indexed)
-    if reverse_input:
-        x = np.array(x[::-1])
-    # add batch dim
-    x = x[np.newaxis, :]
-    len_x = np.array([len_x])
+# padded input of a batch of examples, which must be sorted by decreasing length
+def make_input_tensor(exs, input_indexer, reverse_input):
+    len_x = np.array([len(ex.x_indexed) for ex in exs])
+    x = make_padded_input_tensor(exs, input_indexer, np.max(len_x), reverse_input)
     x = torch.from_numpy(x).long()
     len_x = torch.from_numpy(len_x)
     return x, len_x
@@ -87,50 +89,41 @@ def test_model(model_path, test_data, input_indexer, output_indexer, args):
     model_output_emb.eval()
     model_dec.eval()
 
-    pred_derivations = []
-    with torch.no_grad():
-        for i, ex in enumerate(test_data):
-            if i % 50 == 0:
-                print("Done", i)
-            x, len_x = make_input_tensor(ex, args.reverse_input)
+    # longest first, as pack_padded_sequence wants; the artifact is indexed by example id, so
+    # examples are written in the order they are decoded
+    order = sorted(range(len(test_data)), key=lambda i: len(test_data[i].x_indexed), reverse=True)
+    decode_file = get_decode_file(args.dataset, args.split, args.model_id)
+    with torch.no_grad(), DerivationWriter(decode_file) as writer:
+        for start in range(0, len(order), args.batch_size):
+            print("Done", start)
+            batch_ids = order[start:start + args.batch_size]
+            x, len_x = make_input_tensor([test_data[i] for i in batch_ids], input_indexer, args.reverse_input)
             x, len_x = x.to(device), len_x.to(device)
 
             enc_out_each_word, enc_context_mask, enc_final_states = \
                     encode_input_for_decoder(x, len_x, model_input_emb, model_enc)
-            
-            pred_derivations.append(beam_decoder(enc_out_each_word, enc_context_mask, enc_final_states,
-                output_indexer, model_output_emb, model_dec, args.decoder_len_limit, args.beam_size))
 
+            batch_tokens, batch_scores, batch_token_scores = beam_decoder(enc_out_each_word, enc_context_mask,
+                enc_final_states, output_indexer, model_output_emb, model_dec, args.decoder_len_limit, args.beam_size,
+                args.token_scores)
+            for i, tokens, scores, token_scores in zip(batch_ids, batch_tokens, batch_scores, batch_token_scores):
+                ders = ["".join([output_indexer.get_object(t) for t in y]) for y in tokens]
+                writer.write(test_data[i].id, tokens, ders, scores, token_scores)
+    print("Wrote", decode_file)
 
-    output_derivations(test_data, pred_derivations, args, out_to_folder=True)
+    if args.export_folder:
+        with DerivationFile(decode_file) as derivations:
+            export_folder(derivations, get_decode_folder(args.dataset, args.split, args.model_id))
 
+# token ids, sum log probs and, with token_scores, token log probs of the k-best derivations of
+# every example in the batch (None per example without)
 def beam_decoder(enc_out_each_word, enc_context_mask, enc_final_states, output_indexer,
-                    model_output_emb, model_dec, decoder_len_limit, beam_size):
-    ders, scores = batched_beam_sampling(enc_out_each_word, enc_context_mask, enc_final_states, output_indexer,
-                    model_output_emb, model_dec, decoder_len_limit, beam_size)
-    pred_tokens = [[output_indexer.get_object(t) for t in y] for y in ders]
-    return pred_tokens
-
-def makedir_f(dir):
-    if os.path.exists(dir):
-        shutil.rmtree(dir)
-    os.makedirs(dir)
-
-def output_derivations(test_data, pred_derivations, args, out_to_folder=False):
-
-    if out_to_folder:
-        outfolder = join('decodes/', args.dataset, '{}-{}'.format(args.split, args.model_id))
-        makedir_f(outfolder)
-        for i, pred_ders in enumerate(pred_derivations):
-            lines = "\n".join(["{} {}".format(x[0], "".join(x[1])) for x in enumerate(pred_ders)])
-            with open(join(outfolder, str(i + 1)), "w") as out:
-                out.writelines(lines)
-    else:
-        selected_derivs = [x[0] for x in pred_derivations]
-        # Writes to the output file if needed
-        with open(args.outfile, "w") as out:
-            for i, ex in enumerate(test_data):
-                out.write("".join(selected_derivs[i]) + "\n")
+                    model_output_emb, model_dec, decoder_len_limit, beam_size, token_scores=False):
+    outputs = multi_beam_sampling(enc_out_each_word, enc_context_mask, enc_final_states, output_indexer,
+                    model_output_emb, model_dec, decoder_len_limit, beam_size, token_scores)
+    batch_ders, sum_probs = outputs[0], outputs[1].tolist()
+    batch_token_scores = outputs[2] if token_scores else [None] * len(batch_ders)
+    return batch_ders, [scores[:len(ders)] for ders, scores in zip(batch_ders, sum_probs)], batch_token_scores
 
 def dfa_evaluate(test_data, pred_derivations, print_output=True, outfile=None):
     # e = GeoqueryDomain()
@@ -182,6 +175,8 @@ if __name__ == '__main__':
     # Load the training and test data
     test, input_indexer, output_indexer = load_test_dataset(args.dataset, args.split)
     test_data_indexed = index_data(test, input_indexer, output_indexer, args.decoder_len_limit)
+    if args.grammar_mask:
+        config.grammar = make_sketch_automaton(args.dataset, output_indexer)
     # test_data_indexed = tricky_filter_data(test_data_indexed)
     print(len(test_data_indexed))
     print("%i test exs, %i input types, %i output types" % (len(test_data_indexed), len(input_indexer), len(output_indexer)))
@@ -0,0 +1,187 @@
+# Decode artifacts: the k-best derivations of every example of a split in one JSONL file,
+# decodes/<dataset>/<split>-<model_id>.jsonl. Each line is one example,
+#   {"id": 12, "tokens": [[5, 9, ...], ...], "ders": ["?{<num>}", ...], "scores": [-1.3, ...],
+#    "lengths": [4, ...], "token_scores": [[-0.2, ...], ...]}
+# with the token ids, the derivation strings, the sum log prob and the number of tokens (EOS not
+# counted) of every hypothesis, best first. token_scores, the log prob of every token with the
+# EOS last, is only there when the decode was asked for it.
+# Examples are appended as they are decoded, in any order, and closing the file appends a last
+# line {"index": [[id, offset], ...]} with the byte offset of every example. Readers memory-map
+# the file and seek to an example through the index; a file whose writer was interrupted has no
+# index and is scanned instead, dropping a torn last line.
+# The old layout, one "rank derivation" text file per example in
+# decodes/<dataset>/<split>-<model_id>/, is an export (export_folder, or
+# python derivations.py <dataset> <model_id> --split <split>).
+# The stored scores let select_derivations rerank and cut the k-best lists without the model.
+import argparse
+import json
+import math
+import mmap
+import os
+import shutil
+from os.path import join, dirname
+from data import get_decode_file, get_decode_folder
+
+class DerivationWriter(object):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(dirname(path), exist_ok=True)
+        self.file = open(path, 'wb')
+        self.offsets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, id, tokens, ders, scores, token_scores=None):
+        record = {"id": id, "tokens": tokens, "ders": ders, "scores": scores,
+            "lengths": [len(x) for x in tokens]}
+        if token_scores is not None:
+            record["token_scores"] = token_scores
+        self.offsets.append((id, self.file.tell()))
+        self.file.write(json.dumps(record).encode('utf-8') + b'\n')
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.write(json.dumps({"index": self.offsets}).encode('utf-8') + b'\n')
+        self.file.close()
+        self.file = None
+
+class DerivationFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        # mmap cannot map an empty file
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b''
+        self.offsets = self.read_index()
+        if self.offsets is None:
+            self.offsets = dict((record["id"], offset) for offset, record in self.scan())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, id):
+        return id in self.offsets
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def line_at(self, offset):
+        end = self.data.find(b'\n', offset)
+        return json.loads(self.data[offset:end])
+
+    # id -> offset from the index line, None when the file has none
+    def read_index(self):
+        if self.data[-1:] != b'\n':
+            return None
+        start = self.data.rfind(b'\n', 0, len(self.data) - 1) + 1
+        last = self.line_at(start)
+        if "index" not in last:
+            return None
+        return dict((id, offset) for id, offset in last["index"])
+
+    # (offset, record) of every example in file order
+    def scan(self):
+        offset = 0
+        while True:
+            end = self.data.find(b'\n', offset)
+            if end == -1:
+                return
+            record = json.loads(self.data[offset:end])
+            if "index" in record:
+                return
+            yield offset, record
+            offset = end + 1
+
+    def ids(self):
+        return list(self.offsets)
+
+    # the record of an example, None if it was not decoded
+    def get(self, id):
+        offset = self.offsets.get(id)
+        return None if offset is None else self.line_at(offset)
+
+    # the derivation strings of every example in data, in the order of data, selected from the
+    # stored k-best by select_derivations
+    def read(self, data, policy="beam", length_alpha=1.0, top_k=None, min_prob=None):
+        ders = []
+        for ex in data:
+            record = self.get(ex.id)
+            if record is None:
+                raise ValueError("No derivations of example {} in {}".format(ex.id, self.path))
+            ders.append(select_derivations(record, policy, length_alpha, top_k, min_prob))
+        return ders
+
+# ranking of the stored hypotheses:
+#   beam         sum log prob, the order they were decoded in
+#   length_norm  sum log prob / (length + 1) ** length_alpha, the EOS counted in the length
+#   min_token    log prob of the least likely token, needs a decode with token scores
+RERANK_POLICIES = ["beam", "length_norm", "min_token"]
+
+# score of every hypothesis of a record under a policy, higher is better
+def policy_scores(record, policy, length_alpha=1.0):
+    if policy == "beam":
+        return record["scores"]
+    if policy == "length_norm":
+        # decodes written before lengths were stored
+        lengths = record.get("lengths", [len(x) for x in record["tokens"]])
+        return [score / (length + 1) ** length_alpha for score, length in zip(record["scores"], lengths)]
+    if policy == "min_token":
+        if "token_scores" not in record:
+            raise ValueError("Policy min_token needs token scores, decode with --token_scores")
+        return [min(x) for x in record["token_scores"]]
+    raise ValueError("Unknown rerank policy {}".format(policy))
+
+# the derivation strings of a record reranked by policy. Hypotheses whose probability, normalized
+# over the stored k-best, is below min_prob are dropped, except for the top ranked one, so every
+# decoded example keeps a derivation, and at most top_k are kept.
+def select_derivations(record, policy="beam", length_alpha=1.0, top_k=None, min_prob=None):
+    if top_k is not None and top_k < 1:
+        raise ValueError("top_k has to keep at least one derivation, not {}".format(top_k))
+    ranking = policy_scores(record, policy, length_alpha)
+    # stable, ties keep the beam order
+    hyps = sorted(range(len(record["ders"])), key=lambda i: -ranking[i])
+    if min_prob is not None and hyps:
+        scores = record["scores"]
+        best = max(scores)
+        total = best + math.log(sum(math.exp(x - best) for x in scores))
+        hyps = hyps[:1] + [i for i in hyps[1:] if math.exp(scores[i] - total) >= min_prob]
+    if top_k is not None:
+        hyps = hyps[:top_k]
+    return [record["ders"][i] for i in hyps]
+
+# writes the old layout, one file per example named by its id with a "rank derivation" line
+# per hypothesis
+def export_folder(derivations, folder):
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    for _, record in derivations.scan():
+        lines = "\n".join(["{} {}".format(rank, der) for rank, der in enumerate(record["ders"])])
+        with open(join(folder, str(record["id"])), "w") as out:
+            out.writelines(lines)
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='derivations.py')
+    parser.add_argument('dataset', help='specified dataset')
+    parser.add_argument('model_id', help='specified model id')
+    parser.add_argument('--split', type=str, default='test', help='test split')
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    # exports decodes/<dataset>/<split>-<model_id>.jsonl as the folder of the old layout
+    args = _parse_args()
+    with DerivationFile(get_decode_file(args.dataset, args.split, args.model_id)) as derivations:
+        export_folder(derivations, get_decode_folder(args.dataset, args.split, args.model_id))
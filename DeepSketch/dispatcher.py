@@ -0,0 +1,126 @@
+# asyncio dispatcher for oracle calls. Synthesizer and regex_dfa_equals.jar calls are
+# child processes started with asyncio.create_subprocess_exec, so waiting on them costs no
+# extra Python process; a semaphore bounds how many run at once. The native DFA engine is
+# CPU bound and runs in a process executor instead.
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from SynthCache import DFAWorker, parse_synth_output
+from external.regexDFAEquals import unprocess_regex
+
+DFA_JAR = ['java', '-jar', './external/regex_dfa_equals.jar']
+DFA_TIMEOUT = 2
+
+class OracleDispatcher(object):
+    def __init__(self, concurrency=5):
+        self.concurrency = concurrency
+        self.executor = None
+        self.semaphore = None
+        # seconds every oracle call of the last dispatch ran, not counting the wait for a slot
+        self.call_seconds = []
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # one child process under the semaphore, killed when it runs out of time or is cancelled
+    async def run_process(self, cmd, timeout):
+        async with self.semaphore:
+            t_start = time.monotonic()
+            proc = await asyncio.create_subprocess_exec(*cmd,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            try:
+                out, _ = await asyncio.wait_for(proc.communicate(), timeout)
+            except BaseException as e:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                # a call that ran out of time counts, a cancelled one does not
+                if isinstance(e, asyncio.TimeoutError):
+                    self.call_seconds.append(time.monotonic() - t_start)
+                raise
+            self.call_seconds.append(time.monotonic() - t_start)
+            return proc.returncode, out
+
+    # same results as SynthWorker.run
+    async def synth(self, worker, to_test):
+        try:
+            code, out = await self.run_process(worker.command(to_test), worker.timeout)
+        except asyncio.TimeoutError:
+            return "timeout"
+        except OSError:
+            return "wrong"
+        if code != 0:
+            return "wrong"
+        return parse_synth_output(str(out))
+
+    # same results as DFAWorker.run_many
+    async def dfa_many(self, worker, task):
+        if worker.engine == "native":
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.concurrency)
+            results, seconds = await asyncio.get_running_loop().run_in_executor(self.executor, worker.timed_run_many, task)
+            self.call_seconds.extend([seconds] * len(results))
+            return results
+        return await asyncio.gather(*[self.dfa_jar(task[0], pred) for pred in task[1]])
+
+    async def dfa_jar(self, gold, predicted):
+        gold = unprocess_regex(gold)
+        predicted = unprocess_regex(predicted)
+        if gold == predicted:
+            return "true"
+        try:
+            _, out = await self.run_process(DFA_JAR + [gold, predicted], DFA_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            return "false"
+        return "true" if '\\n1' in str(out) else "false"
+
+    # Runs jobs, each a function returning a coroutine, and hands (index, result) to on_result
+    # as soon as a job finishes. on_result may return indices of jobs that no longer matter;
+    # those are cancelled, killing their process or never starting it. Jobs are admitted by
+    # the semaphore in list order. Returns the results, None for cancelled jobs.
+    async def run_jobs(self, jobs, on_result=None):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        results = [None] * len(jobs)
+        tasks = {}
+        for i, job in enumerate(jobs):
+            tasks[asyncio.ensure_future(job())] = i
+        index_task = dict((i, t) for t, i in tasks.items())
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    i = tasks[task]
+                    results[i] = task.result()
+                    cancel = on_result(i, results[i]) if on_result is not None else None
+                    for k in cancel or []:
+                        index_task[k].cancel()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return results
+
+    def dispatch(self, jobs, on_result=None):
+        self.call_seconds = []
+        if not jobs:
+            return []
+        return asyncio.run(self.run_jobs(jobs, on_result))
+
+    def map_synth(self, worker, to_test_pool, on_result=None):
+        jobs = [lambda x=x: self.synth(worker, x) for x in to_test_pool]
+        return self.dispatch(jobs, on_result)
+
+    def map_dfa_many(self, worker, tasks, on_result=None):
+        jobs = [lambda x=x: self.dfa_many(worker, x) for x in tasks]
+        return self.dispatch(jobs, on_result)
@@ -1,4 +1,8 @@
 from SynthCache import *
+from dispatcher import OracleDispatcher
+from cost_model import CostModel, run_cheapest_first
+from cache_stats import cache_stats_json
+from derivations import DerivationFile, export_folder
 from data import *
 from os.path import join
 import numpy as np
@@ -6,6 +10,7 @@ import multiprocessing as mp
 import argparse
 from external.regexDFAEquals import dfa_eual_test
 import sys
+import queue
 import subprocess
 
 
@@ -16,12 +21,32 @@ def _parse_args():
     parser.add_argument('model_id', help='specified model id')
     parser.add_argument('--split', type=str, default='test', help='test split')
     parser.add_argument('--cache_id', type=str, default="cache", help='cache_id')
+    parser.add_argument('--dfa_engine', type=str, default="native", help='DFA equivalence engine, native or jar')
+    parser.add_argument('--cache_store', type=str, default="log", help='cache storage, log, indexed or pickle')
     parser.add_argument('--decoder_len_limit', type=int, default=50, help='output length limit of the decoder')
     parser.add_argument('--do_filter', default=False, action='store_true', help='run filtering on regex dataset')
+    parser.add_argument('--dispatcher', type=str, default="pool", help='how synthesizer calls are run, pool or async')
+    parser.add_argument('--synth_budgets', type=str, default=None, help='comma separated synthesizer budgets in seconds, timed out sketches are retried under the next one')
+    parser.add_argument('--cost_model', type=str, default=None, help='synthesis cost model file, sketches are synthesized cheapest first')
+    parser.add_argument('--skip_timeout_p', type=float, default=None, help='skip sketches the cost model gives a larger chance of timing out')
+    parser.add_argument('--first_decisive', default=False, action='store_true', help='stop synthesizing the sketches of an example once a higher ranked one is decisive')
+    parser.add_argument('--rerank', type=str, default="beam", help='order of the stored k-best, beam, length_norm or min_token')
+    parser.add_argument('--length_alpha', type=float, default=1.0, help='length penalty exponent of --rerank length_norm')
+    parser.add_argument('--top_k', type=int, default=None, help='only evaluate the first k derivations of an example')
+    parser.add_argument('--min_prob', type=float, default=None, help='drop derivations less likely than this among the stored k-best')
 
     args = parser.parse_args()
     return args
 
+# results that settle an example in print_stats, lower ranked sketches are never looked at
+DECISIVE_RESULTS = ["true", "false", "empty"]
+
+def decisive_rank(results):
+    for j, res in enumerate(results):
+        if res in DECISIVE_RESULTS:
+            return j
+    return len(results)
+
 def print_stats(stats):
     first_true = []
     first_false = []
@@ -106,35 +131,118 @@ def debug_stats(stats):
         print(i + 1, results)
 
 
-def parallel_oracle_evaluate(test_data, pred_derivations, split, cache):
-    batch_results = []
+# Without a dispatcher the sketches of every budget stage go through oracle_pool, which keeps its
+# processes from one stage to the next.
+def parallel_oracle_evaluate(test_data, pred_derivations, split, cache, dispatcher=None, cost_model=None, skip_timeout_p=None,
+        oracle_pool=None):
+    batch_results, to_test_pool, id_pool = pool_sketch_queries(cache, split, [ex.id for ex in test_data],
+        [["".join(seq) for seq in tokens] for tokens in pred_derivations])
+    print("Pool Size", len(to_test_pool))
+    dataset = cache.dataset
+    workers = dict((budget, SynthWorker(dataset, split, budget))
+        for budget in cache.budget_schedule)
+    if dispatcher is None:
+        # registering a worker restarts the pool, so the workers of all stages are registered first
+        for budget, worker in workers.items():
+            oracle_pool.register("synth-{}-{}".format(split, budget), worker)
 
-    id_pool = []
-    to_test_pool = []
-    for i, tokens in enumerate(pred_derivations):
-        single_results = []
+    def run_stage(budget, to_tests):
+        worker = workers[budget]
 
-        for j, seq in enumerate(tokens): 
-            sketch = "".join(seq)
-            # result = cache.query(split, test_data[i].id, sketch)
-            result = cache.soft_query(split, test_data[i].id, sketch)
-            if result is None:
-                id_pool.append((i, j))
-                to_test_pool.append((test_data[i].id, sketch))
+        def run(to_tests):
+            if dispatcher is not None:
+                results = dispatcher.map_synth(worker, to_tests)
+                cache.stats.record_latencies(dispatcher.call_seconds)
+                return results
+            name = "synth-{}-{}".format(split, budget)
+            timed_results = oracle_pool.map(name, "timed_run", to_tests, chunksize=1)
+            cache.stats.record_latencies([seconds for _, seconds in timed_results])
+            return [result for result, _ in timed_results]
 
-            single_results.append(result)
-        batch_results.append(single_results)
-    
-    print("Pool Size", len(to_test_pool))
+        return run_cheapest_first(cost_model, split, budget, to_tests, run, skip_timeout_p)
+
+    run_sketch_queries(cache, split, to_test_pool, id_pool, batch_results, run_stage)
+    print_stats(batch_results)
+
+# Same outcome as parallel_oracle_evaluate, but sketches are synthesized in rank order (the
+# top sketch of every example first) and a sketch is only started while no higher ranked
+# sketch of its example is known to be decisive. Once every example is settled the pool is
+# terminated, dropping the lower ranked runs still in flight. Sketches that were skipped or
+# dropped stay None in the results and are not written to the cache. With a dispatcher the
+# lower ranked runs of a settled example are cancelled as soon as it is settled. Sketches
+# run once, under the largest budget of the schedule.
+def ranked_oracle_evaluate(test_data, pred_derivations, split, cache, num_workers=5, dispatcher=None):
+    batch_results, to_test_pool, id_pool = pool_sketch_queries(cache, split, [ex.id for ex in test_data],
+        [["".join(seq) for seq in tokens] for tokens in pred_derivations])
+    # every (rank, example) the oracle has to answer, in rank order; the same sketch can show up
+    # at several ranks of an example
+    candidates = sorted((j, i, to_test) for to_test, ids in zip(to_test_pool, id_pool) for i, j in ids)
+    positions = {}
+    for j, i, to_test in candidates:
+        positions.setdefault(to_test, []).append((i, j))
+    needed = lambda to_test: any(j < decisive_rank(batch_results[i]) for i, j in positions[to_test])
+
+    print("Pool Size", len(positions))
     dataset = cache.dataset
-    worker = SynthWorker(dataset, split)
-    pool = mp.Pool(5)
-    results_pool = pool.map(worker.run, to_test_pool)
-    pool.close()
-
-    for res_id, to_test in enumerate(to_test_pool):
-        batch_results[id_pool[res_id][0]][id_pool[res_id][1]] = results_pool[res_id]
-        cache.soft_write(split, to_test[0], to_test[1], results_pool[res_id])
+    budget = cache.max_budget()
+    worker = SynthWorker(dataset, split, budget)
+    if dispatcher is not None:
+        # positions was filled in rank order, so is the dispatch order
+        to_test_pool = list(positions)
+        example_jobs = {}
+        for k, to_test in enumerate(to_test_pool):
+            for i, _ in positions[to_test]:
+                example_jobs.setdefault(i, []).append(k)
+        finished_jobs = set()
+
+        def on_result(k, result):
+            finished_jobs.add(k)
+            to_test = to_test_pool[k]
+            for i, j in positions[to_test]:
+                batch_results[i][j] = result
+            cache.soft_write(split, to_test[0], to_test[1], result, budget)
+            return [x for i, _ in positions[to_test] for x in example_jobs[i]
+                if x not in finished_jobs and not needed(to_test_pool[x])]
+
+        dispatcher.map_synth(worker, to_test_pool, on_result)
+        cache.stats.record_latencies(dispatcher.call_seconds)
+        print("Synthesized {} of {} sketches".format(len(finished_jobs), len(positions)))
+        print_stats(batch_results)
+        return
+
+    pool = mp.Pool(num_workers)
+    finished = queue.Queue()
+    started = set()
+    running = set()
+    next_candidate = 0
+    try:
+        while True:
+            while len(running) < num_workers and next_candidate < len(candidates):
+                to_test = candidates[next_candidate][2]
+                next_candidate += 1
+                if to_test in started or not needed(to_test):
+                    continue
+                started.add(to_test)
+                running.add(to_test)
+                pool.apply_async(worker.timed_run, (to_test,),
+                    callback=lambda res, to_test=to_test: finished.put((to_test, res, None)),
+                    error_callback=lambda err, to_test=to_test: finished.put((to_test, None, err)))
+            if next_candidate == len(candidates) and not any(needed(x) for x in running):
+                break
+            to_test, timed_result, err = finished.get()
+            running.discard(to_test)
+            if err is not None:
+                raise err
+            result, seconds = timed_result
+            cache.stats.record_latency(seconds)
+            for i, j in positions[to_test]:
+                batch_results[i][j] = result
+            cache.soft_write(split, to_test[0], to_test[1], result, budget)
+    finally:
+        pool.terminate()
+
+    print("Synthesized {} of {} sketches, cancelled {} in flight".format(
+        len(started) - len(running), len(positions), len(running)))
     print_stats(batch_results)
 
 def read_sketches(filename):
@@ -159,11 +267,14 @@ def read_derivations(prefix, data):
     return ders
 
 def dfa_acc_evaluate(test_data, pred_derivations, split, cache):
-    selected_derivs = [x[0] for x in pred_derivations]
+    # an example the decoder found no derivation for counts as wrong
+    selected_derivs = [x[0] if x else None for x in pred_derivations]
     num_exact_match = 0
     num_denotation_match = 0
 
     for i, ex in enumerate(test_data):
+        if selected_derivs[i] is None:
+            continue
         y_pred = ''.join(selected_derivs[i])
         gold  = ''.join(ex.y_tok)
         if y_pred == gold:
@@ -189,7 +300,12 @@ def run_filtering_test(args):
         raise RuntimeError('Dataset is not supposed to run filtering test')
     
     example_path = join('external/examples/', dataset_id, f'example-{args.split}') + '/'
-    decodes_path = join('decodes/', args.dataset, '{}-{}'.format(args.split, args.model_id)) + '/'
+    decodes_path = get_decode_folder(args.dataset, args.split, args.model_id) + '/'
+    decode_file = get_decode_file(args.dataset, args.split, args.model_id)
+    if os.path.exists(decode_file):
+        # the filter reads the old layout
+        with DerivationFile(decode_file) as derivations:
+            export_folder(derivations, decodes_path)
     cmd = ["java", "-cp", "external/run_filter.jar:external/lib/*", "-ea", "datagen.Main", mode, 'filter', example_path , decodes_path]
     out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
     out = out.decode('utf-8')
@@ -216,22 +332,43 @@ if __name__ == "__main__":
     args.oracle_mode = 'sketch' if 'Sketch' in args.dataset else 'regex'
 
     if args.oracle_mode == 'sketch':
-        cache = SynthCache(args.cache_id, args.dataset)
+        cache = SynthCache(args.cache_id, args.dataset, store=args.cache_store)
+        if args.synth_budgets is not None:
+            cache.budget_schedule = [float(x) for x in args.synth_budgets.split(',')]
     else:
         if args.do_filter:
             run_filtering_test(args)
             exit()
-        cache = DFACache(args.cache_id, args.dataset)
+        cache = DFACache(args.cache_id, args.dataset, args.dfa_engine, args.cache_store)
 
     test, input_indexer, output_indexer = load_test_dataset(args.dataset, args.split)
     test_data_indexed = index_data(test, input_indexer, output_indexer, args.decoder_len_limit)
     test_data_indexed = filter_data(test_data_indexed)
 
-    decode_folder = join('decodes/', args.dataset, '{}-{}'.format(args.split, args.model_id))
-    pred_derivations = read_derivations(decode_folder, test_data_indexed)
+    decode_file = get_decode_file(args.dataset, args.split, args.model_id)
+    if os.path.exists(decode_file):
+        with DerivationFile(decode_file) as derivations:
+            pred_derivations = derivations.read(test_data_indexed, args.rerank, args.length_alpha, args.top_k, args.min_prob)
+    else:
+        # decodes written before the single file artifact, which have no scores
+        if args.rerank != "beam" or args.min_prob is not None:
+            raise ValueError("Reranking needs the scores of {}".format(decode_file))
+        pred_derivations = read_derivations(get_decode_folder(args.dataset, args.split, args.model_id), test_data_indexed)
+        if args.top_k is not None:
+            if args.top_k < 1:
+                raise ValueError("top_k has to keep at least one derivation, not {}".format(args.top_k))
+            pred_derivations = [x[:args.top_k] for x in pred_derivations]
 
-    if args.oracle_mode == 'sketch':
-        parallel_oracle_evaluate(test_data_indexed, pred_derivations, args.split, cache)
+    dispatcher = OracleDispatcher() if args.dispatcher == 'async' else None
+    cost_model = CostModel.load(args.cost_model) if args.cost_model is not None else None
+    if args.oracle_mode == 'sketch' and args.first_decisive:
+        ranked_oracle_evaluate(test_data_indexed, pred_derivations, args.split, cache, dispatcher=dispatcher)
+    elif args.oracle_mode == 'sketch':
+        with OraclePool() as oracle_pool:
+            parallel_oracle_evaluate(test_data_indexed, pred_derivations, args.split, cache, dispatcher, cost_model,
+                args.skip_timeout_p, oracle_pool)
     else:
         dfa_acc_evaluate(test_data_indexed, pred_derivations, args.split, cache)
     cache.rewrite()
+    print(cache_stats_json(cache, "run", split=args.split, model_id=args.model_id))
+    cache.close()
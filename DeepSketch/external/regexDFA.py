@@ -0,0 +1,442 @@
+# In-process DFA equivalence for the (unprocessed) regex language of Turk / KB13.
+# The accepted syntax is the one of dk.brics.automaton.RegExp, which is what
+# regex_dfa_equals.jar uses:
+#   union       a|b          intersection  a&b          concatenation  ab
+#   repetition  a* a+ a? a{n} a{n,} a{n,m}                complement     ~a
+#   classes     [abc] [a-z] [^0-9]   any char .   escape \c   string "abc"
+#   empty language #   any string @   empty string ()
+# Automata are built over a partition of the code points into groups that no character
+# class of the compared regexes separates, so a DFA only has a handful of symbols.
+# Two regexes can also be compared through regex_fingerprint, a hash of the canonical
+# minimal DFA that does not depend on the alphabet it was built over.
+import hashlib
+
+MAX_CHAR = 0x10FFFF
+
+class RegexParseError(ValueError):
+    pass
+
+# AST nodes are plain tuples so that equal subexpressions hash equal
+#   ('chars', ((lo, hi), ...))   ('eps',)   ('empty',)   ('anystr',)
+#   ('concat', a, b)   ('union', a, b)   ('inter', a, b)   ('compl', a)
+#   ('repeat', a, min, max)   max is None for unbounded
+ANY_CHAR = ('chars', ((0, MAX_CHAR),))
+
+def make_chars(ranges):
+    ranges = sorted(ranges)
+    merged = []
+    for lo, hi in ranges:
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return ('chars', tuple(merged))
+
+def negate_chars(node):
+    ranges = []
+    lo = 0
+    for a, b in node[1]:
+        if a > lo:
+            ranges.append((lo, a - 1))
+        lo = b + 1
+    if lo <= MAX_CHAR:
+        ranges.append((lo, MAX_CHAR))
+    return ('chars', tuple(ranges))
+
+class RegexParser(object):
+    def __init__(self, regex):
+        self.s = regex
+        self.pos = 0
+
+    def parse(self):
+        e = self.parse_union()
+        if self.pos < len(self.s):
+            raise RegexParseError("end-of-string expected at position {}".format(self.pos))
+        return e
+
+    def more(self):
+        return self.pos < len(self.s)
+
+    def peek(self, chars):
+        return self.more() and self.s[self.pos] in chars
+
+    def match(self, c):
+        if self.more() and self.s[self.pos] == c:
+            self.pos += 1
+            return True
+        return False
+
+    def next(self):
+        if not self.more():
+            raise RegexParseError("unexpected end-of-string")
+        c = self.s[self.pos]
+        self.pos += 1
+        return c
+
+    def parse_union(self):
+        e = self.parse_inter()
+        if self.match('|'):
+            e = ('union', e, self.parse_union())
+        return e
+
+    def parse_inter(self):
+        e = self.parse_concat()
+        if self.match('&'):
+            e = ('inter', e, self.parse_inter())
+        return e
+
+    def parse_concat(self):
+        e = self.parse_repeat()
+        if self.more() and not self.peek(')|&'):
+            e = ('concat', e, self.parse_concat())
+        return e
+
+    def parse_int(self):
+        start = self.pos
+        while self.peek('0123456789'):
+            self.pos += 1
+        if start == self.pos:
+            return None
+        return int(self.s[start:self.pos])
+
+    def parse_repeat(self):
+        e = self.parse_compl()
+        while self.peek('?*+{'):
+            if self.match('?'):
+                e = ('repeat', e, 0, 1)
+            elif self.match('*'):
+                e = ('repeat', e, 0, None)
+            elif self.match('+'):
+                e = ('repeat', e, 1, None)
+            elif self.match('{'):
+                n = self.parse_int()
+                if n is None:
+                    raise RegexParseError("integer expected at position {}".format(self.pos))
+                m = n
+                if self.match(','):
+                    m = self.parse_int()
+                if not self.match('}'):
+                    raise RegexParseError("expected '}}' at position {}".format(self.pos))
+                e = ('repeat', e, n, m)
+        return e
+
+    def parse_compl(self):
+        if self.match('~'):
+            return ('compl', self.parse_compl())
+        return self.parse_charclass_exp()
+
+    def parse_charclass_exp(self):
+        if self.match('['):
+            negate = self.match('^')
+            ranges = self.parse_charclasses()
+            if not self.match(']'):
+                raise RegexParseError("expected ']' at position {}".format(self.pos))
+            e = make_chars(ranges)
+            return negate_chars(e) if negate else e
+        return self.parse_simple()
+
+    def parse_charclasses(self):
+        ranges = self.parse_charclass()
+        while self.more() and not self.peek(']'):
+            ranges = ranges + self.parse_charclass()
+        return ranges
+
+    def parse_charclass(self):
+        c = self.parse_charexp()
+        if self.match('-'):
+            if self.peek(']'):
+                return [(ord(c), ord(c)), (ord('-'), ord('-'))]
+            d = self.parse_charexp()
+            if c > d:
+                raise RegexParseError("invalid range at position {}".format(self.pos))
+            return [(ord(c), ord(d))]
+        return [(ord(c), ord(c))]
+
+    def parse_simple(self):
+        if self.match('.'):
+            return ANY_CHAR
+        if self.match('#'):
+            return ('empty',)
+        if self.match('@'):
+            return ('anystr',)
+        if self.match('"'):
+            end = self.s.find('"', self.pos)
+            if end == -1:
+                raise RegexParseError("expected '\"' at position {}".format(self.pos))
+            e = ('eps',)
+            for c in reversed(self.s[self.pos:end]):
+                e = ('concat', ('chars', ((ord(c), ord(c)),)), e)
+            self.pos = end + 1
+            return e
+        if self.match('('):
+            if self.match(')'):
+                return ('eps',)
+            e = self.parse_union()
+            if not self.match(')'):
+                raise RegexParseError("expected ')' at position {}".format(self.pos))
+            return e
+        if self.peek('<'):
+            # named automata and numerical intervals are not used by the datasets
+            raise RegexParseError("unsupported '<' at position {}".format(self.pos))
+        c = self.parse_charexp()
+        return ('chars', ((ord(c), ord(c)),))
+
+    def parse_charexp(self):
+        self.match('\\')
+        return self.next()
+
+def parse_regex(regex):
+    return RegexParser(regex).parse()
+
+def collect_charsets(node, charsets):
+    if node[0] == 'chars':
+        charsets.add(node[1])
+    else:
+        for child in node[1:]:
+            if isinstance(child, tuple):
+                collect_charsets(child, charsets)
+    return charsets
+
+class Alphabet(object):
+    # Code points that belong to exactly the same character classes of the compared
+    # regexes can never be told apart, so each group of them is a single DFA symbol.
+    # A symbol is a list of disjoint code point intervals.
+    def __init__(self, charsets):
+        charsets = sorted(charsets)
+        bounds = {0}
+        for ranges in charsets:
+            for lo, hi in ranges:
+                bounds.add(lo)
+                bounds.add(hi + 1)
+        starts = sorted(b for b in bounds if b <= MAX_CHAR)
+        groups = {}
+        self.intervals = []
+        for i, lo in enumerate(starts):
+            hi = starts[i + 1] - 1 if i + 1 < len(starts) else MAX_CHAR
+            sig = tuple(any(a <= lo and hi <= b for a, b in ranges) for ranges in charsets)
+            if sig not in groups:
+                groups[sig] = len(groups)
+                self.intervals.append([])
+            self.intervals[groups[sig]].append((lo, hi))
+        self.members = {}
+        for ranges in charsets:
+            self.members[ranges] = set(groups[sig] for sig in groups if sig[charsets.index(ranges)])
+
+    @classmethod
+    def of(cls, *nodes):
+        charsets = set()
+        for node in nodes:
+            collect_charsets(node, charsets)
+        return cls(charsets)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def symbols(self, ranges):
+        return self.members[ranges]
+
+    def symbol(self, c):
+        o = ord(c)
+        for sym, intervals in enumerate(self.intervals):
+            if any(lo <= o <= hi for lo, hi in intervals):
+                return sym
+
+# Complete DFA, start state is 0; trans[s][a] is the successor of s on symbol a
+class DFA(object):
+    __slots__ = ('trans', 'accept')
+
+    def __init__(self, trans, accept):
+        self.trans = trans
+        self.accept = accept
+
+    def __len__(self):
+        return len(self.accept)
+
+def explore(start, step, is_accept, nsym):
+    # builds the reachable part of an implicitly given automaton
+    ids = {start: 0}
+    todo = [start]
+    trans = []
+    accept = []
+    for key in todo:
+        accept.append(is_accept(key))
+        row = []
+        for a in range(nsym):
+            nxt = step(key, a)
+            if nxt not in ids:
+                ids[nxt] = len(ids)
+                todo.append(nxt)
+            row.append(ids[nxt])
+        trans.append(row)
+    return DFA(trans, accept)
+
+def minimize(dfa):
+    # Moore partition refinement followed by a canonical BFS numbering, so two minimal
+    # DFAs over the same alphabet accept the same language iff they are equal
+    n = len(dfa)
+    block = [1 if acc else 0 for acc in dfa.accept]
+    num_blocks = len(set(block))
+    while True:
+        sigs = {}
+        new_block = []
+        for s in range(n):
+            sig = (block[s],) + tuple(block[t] for t in dfa.trans[s])
+            if sig not in sigs:
+                sigs[sig] = len(sigs)
+            new_block.append(sigs[sig])
+        block = new_block
+        if len(sigs) == num_blocks:
+            break
+        num_blocks = len(sigs)
+    rep = {}
+    for s in range(n):
+        rep.setdefault(block[s], s)
+    return explore(block[0], lambda b, a: block[dfa.trans[rep[b]][a]], lambda b: dfa.accept[rep[b]], len(dfa.trans[0]))
+
+def chars_dfa(syms, nsym):
+    return DFA([[1 if a in syms else 2 for a in range(nsym)], [2] * nsym, [2] * nsym], [False, True, False])
+
+def product(d1, d2, op):
+    nsym = len(d1.trans[0])
+    return minimize(explore((0, 0), lambda p, a: (d1.trans[p[0]][a], d2.trans[p[1]][a]),
+        lambda p: op(d1.accept[p[0]], d2.accept[p[1]]), nsym))
+
+def complement(d):
+    return minimize(DFA(d.trans, [not acc for acc in d.accept]))
+
+def concat(d1, d2):
+    # states are (state of d1, set of states of d2 reached so far)
+    nsym = len(d1.trans[0])
+    start = (0, frozenset([0]) if d1.accept[0] else frozenset())
+
+    def step(key, a):
+        p, qs = key
+        p = d1.trans[p][a]
+        qs = set(d2.trans[q][a] for q in qs)
+        if d1.accept[p]:
+            qs.add(0)
+        return p, frozenset(qs)
+
+    return minimize(explore(start, step, lambda key: any(d2.accept[q] for q in key[1]), nsym))
+
+def star(d):
+    nsym = len(d.trans[0])
+
+    def step(key, a):
+        qs = set(d.trans[q][a] for q in (key if key is not None else (0,)))
+        if any(d.accept[q] for q in qs):
+            qs.add(0)
+        return frozenset(qs)
+
+    return minimize(explore(None, step, lambda key: key is None or any(d.accept[q] for q in key), nsym))
+
+def epsilon_dfa(nsym):
+    return DFA([[1] * nsym, [1] * nsym], [True, False])
+
+def repeat(d, low, high):
+    nsym = len(d.trans[0])
+    if high is not None and low > high:
+        return DFA([[0] * nsym], [False])
+    result = epsilon_dfa(nsym)
+    for _ in range(low):
+        result = concat(result, d)
+    if high is None:
+        return concat(result, star(d))
+    optional = product(d, epsilon_dfa(nsym), lambda x, y: x or y)
+    for _ in range(high - low):
+        result = concat(result, optional)
+    return result
+
+def compile_node(node, alphabet, memo):
+    if node in memo:
+        return memo[node]
+    nsym = len(alphabet)
+    kind = node[0]
+    if kind == 'chars':
+        d = chars_dfa(alphabet.symbols(node[1]), nsym)
+    elif kind == 'eps':
+        d = epsilon_dfa(nsym)
+    elif kind == 'empty':
+        d = DFA([[0] * nsym], [False])
+    elif kind == 'anystr':
+        d = DFA([[0] * nsym], [True])
+    elif kind == 'concat':
+        d = concat(compile_node(node[1], alphabet, memo), compile_node(node[2], alphabet, memo))
+    elif kind == 'union':
+        d = product(compile_node(node[1], alphabet, memo), compile_node(node[2], alphabet, memo), lambda x, y: x or y)
+    elif kind == 'inter':
+        d = product(compile_node(node[1], alphabet, memo), compile_node(node[2], alphabet, memo), lambda x, y: x and y)
+    elif kind == 'compl':
+        d = complement(compile_node(node[1], alphabet, memo))
+    elif kind == 'repeat':
+        d = repeat(compile_node(node[1], alphabet, memo), node[2], node[3])
+    else:
+        raise RegexParseError("unknown node {}".format(kind))
+    memo[node] = d
+    return d
+
+def compile_regex(node, alphabet):
+    return compile_node(node, alphabet, {})
+
+def product_equivalent(d1, d2):
+    # walks the product automaton looking for a pair of states that disagree
+    seen = {(0, 0)}
+    todo = [(0, 0)]
+    while todo:
+        p, q = todo.pop()
+        if d1.accept[p] != d2.accept[q]:
+            return False
+        for a in range(len(d1.trans[0])):
+            nxt = (d1.trans[p][a], d2.trans[q][a])
+            if nxt not in seen:
+                seen.add(nxt)
+                todo.append(nxt)
+    return True
+
+def regex_equivalent(r1, r2):
+    n1 = parse_regex(r1)
+    n2 = parse_regex(r2)
+    alphabet = Alphabet.of(n1, n2)
+    memo = {}
+    return product_equivalent(compile_node(n1, alphabet, memo), compile_node(n2, alphabet, memo))
+
+def dfa_accepts(dfa, alphabet, string):
+    state = 0
+    for c in string:
+        state = dfa.trans[state][alphabet.symbol(c)]
+    return dfa.accept[state]
+
+def merge_intervals(intervals):
+    merged = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return tuple(merged)
+
+def canonical_form(dfa, alphabet):
+    # Edges of the minimal DFA labelled by the code points they consume rather than by
+    # alphabet symbols, numbered in BFS order of the smallest code point. This only
+    # depends on the language, so it can be compared across regexes compiled separately.
+    dfa = minimize(dfa)
+    edges = []
+    for row in dfa.trans:
+        labels = {}
+        for sym, target in enumerate(row):
+            labels.setdefault(target, []).extend(alphabet.intervals[sym])
+        edges.append(sorted((merge_intervals(ivs), target) for target, ivs in labels.items()))
+    ids = {0: 0}
+    order = [0]
+    for s in order:
+        for _, target in edges[s]:
+            if target not in ids:
+                ids[target] = len(ids)
+                order.append(target)
+    return tuple((dfa.accept[s], tuple((label, ids[t]) for label, t in edges[s])) for s in order)
+
+def regex_fingerprint(regex):
+    node = parse_regex(regex)
+    alphabet = Alphabet.of(node)
+    form = canonical_form(compile_regex(node, alphabet), alphabet)
+    return hashlib.sha1(repr(form).encode('utf-8')).hexdigest()
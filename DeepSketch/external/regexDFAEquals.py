@@ -1,6 +1,7 @@
 import sys
 import argparse
 import subprocess
+from external.regexDFA import regex_equivalent, regex_fingerprint, RegexParseError
 
 def dfa_eual_test(gold, predicted):
     gold = unprocess_regex(gold)
@@ -67,6 +68,54 @@ def silent_regex_equiv(gold, predicted):
         return "false"
     return "false"
 
+# same contract as silent_regex_equiv, decided in-process instead of by regex_dfa_equals.jar
+def native_regex_equiv(gold, predicted):
+    if gold == predicted:
+        return "perfect"
+    try:
+        if regex_equivalent(gold, predicted):
+            return "true"
+        else:
+            return "false"
+    except (RegexParseError, RecursionError):
+        return "false"
+
+def silent_native_eual_test(pair):
+    gold, predicted = pair
+    gold = unprocess_regex(gold)
+    predicted = unprocess_regex(predicted)
+    return native_regex_equiv(gold, predicted)
+
+def native_regex_fingerprint(regex):
+    try:
+        return regex_fingerprint(regex)
+    except (RegexParseError, RecursionError):
+        return None
+
+# one gold against many predictions: the gold automaton is built once (or its fingerprint
+# is passed in precomputed) and every prediction is answered by a fingerprint comparison
+def native_regex_equiv_many(gold, predictions, gold_fingerprint=None):
+    if gold_fingerprint is None:
+        gold_fingerprint = native_regex_fingerprint(gold)
+    results = []
+    for predicted in predictions:
+        if gold == predicted:
+            results.append("perfect")
+        elif gold_fingerprint is None:
+            results.append("false")
+        elif native_regex_fingerprint(predicted) == gold_fingerprint:
+            results.append("true")
+        else:
+            results.append("false")
+    return results
+
+def silent_native_eual_many(task):
+    gold, predictions, gold_fingerprint = task
+    return native_regex_equiv_many(unprocess_regex(gold), [unprocess_regex(x) for x in predictions], gold_fingerprint)
+
+def gold_fingerprints(golds):
+    return dict((gold, native_regex_fingerprint(unprocess_regex(gold))) for gold in golds)
+
 def regex_equiv_from_raw(gold, predicted):
     gold = unprocess_regex(gold)
     predicted = unprocess_regex(predicted)
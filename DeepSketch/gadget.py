@@ -7,10 +7,23 @@ from models import *
 from data import *
 from utils import *
 import multiprocessing as mp
-from SynthCache import SynthWorker, DFAWorker
+from SynthCache import SynthWorker, DFAWorker, OraclePool, answer_malformed, well_formed_regex_pair, \
+    pool_sketch_queries, run_sketch_queries
+from grammar import canonical_regex
+from dispatcher import OracleDispatcher
+from cost_model import run_cheapest_first
 
 class config():
     device = None
+    oracle_pool = None
+    # when set, oracle calls go through this OracleDispatcher instead of the pool
+    oracle_dispatcher = None
+    # synthesis cost model, sketches are run cheapest first and optionally skipped when
+    # their chance of timing out is above skip_timeout_p
+    cost_model = None
+    skip_timeout_p = None
+    # SketchAutomaton, when set decoding only emits well-formed sketches
+    grammar = None
 
 def set_global_device(gpu):
     if gpu is not None:
@@ -18,6 +31,39 @@ def set_global_device(gpu):
     else:
         config.device = 'cpu'
     
+# the oracle pool lives for the whole run, set config.oracle_pool to size it and close it when done
+def get_oracle_pool():
+    if config.oracle_pool is None:
+        config.oracle_pool = OraclePool()
+    return config.oracle_pool
+
+def close_oracle_pool():
+    if config.oracle_pool is not None:
+        config.oracle_pool.close()
+        config.oracle_pool = None
+    if config.oracle_dispatcher is not None:
+        config.oracle_dispatcher.close()
+        config.oracle_dispatcher = None
+
+# one synthesizer pass over to_test_pool under the given budget, None for skipped sketches
+def oracle_synth(cache, split, budget, to_test_pool):
+    worker = SynthWorker(cache.dataset, split, budget)
+
+    def run(to_tests):
+        if config.oracle_dispatcher is not None:
+            results = config.oracle_dispatcher.map_synth(worker, to_tests)
+            cache.stats.record_latencies(config.oracle_dispatcher.call_seconds)
+            return results
+        name = "synth-{}-{}".format(split, budget)
+        pool = get_oracle_pool()
+        pool.register(name, worker)
+        # one sketch at a time, so a process that is done takes the next cheapest sketch
+        timed_results = pool.map(name, "timed_run", to_tests, chunksize=1)
+        cache.stats.record_latencies([seconds for _, seconds in timed_results])
+        return [result for result, _ in timed_results]
+
+    return run_cheapest_first(config.cost_model, split, budget, to_test_pool, run, config.skip_timeout_p)
+
 # Analogous to make_padded_input_tensor, but without the option to reverse input
 def make_padded_output_tensor(exs, output_indexer, max_len):
     return np.array([[ex.y_indexed[i] if i < len(ex.y_indexed) else output_indexer.index_of(PAD_SYMBOL) for i in range(0, max_len)] for ex in exs])
@@ -64,6 +110,8 @@ def encode_input_for_decoder(x_tensor, inp_lens_tensor, model_input_emb, model_e
     return (enc_output_each_word, enc_context_mask, enc_final_states_reshaped)
 
 def orcale_reward(batch_tokens, batch_ids, split, cache, output_indexer):
+    # pick up what concurrent jobs sharing the cache found since the last batch
+    cache.refresh()
     batch_ids = batch_ids.numpy()
 
     batch_results = []
@@ -95,6 +143,7 @@ def orcale_reward(batch_tokens, batch_ids, split, cache, output_indexer):
     return batch_rewards, num_coverage, num_match
 
 def dfa_orcale_reward(batch_tokens, batch_ids, split, cache, output_indexer):
+    cache.refresh()
     batch_results = []
     EOS = output_indexer.get_index(EOS_SYMBOL)
     batch_gts = batch_ids.tolist()
@@ -124,6 +173,7 @@ def dfa_orcale_reward(batch_tokens, batch_ids, split, cache, output_indexer):
     return batch_rewards, num_coverage, num_match
 
 def parallel_dfa_reward(batch_tokens, batch_ids, split, cache, output_indexer):
+    cache.refresh()
     batch_ids = batch_ids.tolist()
     EOS = output_indexer.get_index(EOS_SYMBOL)
 
@@ -131,6 +181,7 @@ def parallel_dfa_reward(batch_tokens, batch_ids, split, cache, output_indexer):
 
     id_pool = []
     to_test_pool = []
+    pending = {}
     for i, tokens in enumerate(batch_tokens):
         single_results = []
 
@@ -139,26 +190,48 @@ def parallel_dfa_reward(batch_tokens, batch_ids, split, cache, output_indexer):
             if x == EOS:
                 break
             gold.append(output_indexer.get_object(x))
-        gold = "".join(gold)
+        gold = canonical_regex("".join(gold))
 
         for j, seq in enumerate(tokens): 
-            pred = "".join([output_indexer.get_object(x) for x in seq])
+            pred = canonical_regex("".join([output_indexer.get_object(x) for x in seq]))
             result = cache.soft_query(gold, pred)
             if result is None:
-                id_pool.append((i, j))
-                to_test_pool.append((gold, pred))
+                to_test = (gold, pred)
+                if to_test not in pending:
+                    pending[to_test] = len(to_test_pool)
+                    to_test_pool.append(to_test)
+                    id_pool.append([])
+                id_pool[pending[to_test]].append((i, j))
 
             single_results.append(result)
         batch_results.append(single_results)
     
     # print("Pool Size", len(to_test_pool), file=sys.stderr)
-    worker = DFAWorker()
-    pool = mp.Pool(5)
-    results_pool = pool.map(worker.run, to_test_pool)
-    pool.close()
+    to_test_pool, id_pool = answer_malformed(cache, to_test_pool, id_pool, well_formed_regex_pair, "false", batch_results)
+    # one task per gold, so each gold automaton is built (or looked up) once per batch
+    golds = []
+    gold_preds = {}
+    for gold, pred in to_test_pool:
+        if gold not in gold_preds:
+            golds.append(gold)
+            gold_preds[gold] = []
+        gold_preds[gold].append(pred)
+    tasks = [(gold, gold_preds[gold], cache.gold_fingerprints.get(gold)) for gold in golds]
+    if config.oracle_dispatcher is not None:
+        grouped_results = config.oracle_dispatcher.map_dfa_many(DFAWorker(cache.engine), tasks)
+        cache.stats.record_latencies(config.oracle_dispatcher.call_seconds)
+    else:
+        pool = get_oracle_pool()
+        pool.register("dfa-" + cache.engine, DFAWorker(cache.engine))
+        timed_results = pool.map("dfa-" + cache.engine, "timed_run_many", tasks)
+        grouped_results = [results for results, _ in timed_results]
+        cache.stats.record_latencies([seconds for results, seconds in timed_results for _ in results])
+    gold_results = dict((gold, iter(res)) for gold, res in zip(golds, grouped_results))
+    results_pool = [next(gold_results[gold]) for gold, _ in to_test_pool]
 
     for res_id, to_test in enumerate(to_test_pool):
-        batch_results[id_pool[res_id][0]][id_pool[res_id][1]] = results_pool[res_id]
+        for i, j in id_pool[res_id]:
+            batch_results[i][j] = results_pool[res_id]
         cache.soft_write(to_test[0], to_test[1], results_pool[res_id])
         # print(to_test[0], to_test[1], results_pool[res_id], file=sys.stderr)
 
@@ -178,35 +251,11 @@ def parallel_dfa_reward(batch_tokens, batch_ids, split, cache, output_indexer):
 
 def parallel_orcale_reward(batch_tokens, batch_ids, split, cache, output_indexer):
     batch_ids = batch_ids.numpy()
-
-    batch_results = []
-
-    id_pool = []
-    to_test_pool = []
-    for i, tokens in enumerate(batch_tokens):
-        single_results = []
-
-        for j, seq in enumerate(tokens): 
-            sketch = "".join([output_indexer.get_object(x) for x in seq])
-            result = cache.soft_query(split, batch_ids[i], sketch)
-            if result is None:
-                id_pool.append((i, j))
-                to_test_pool.append((batch_ids[i], sketch))
-
-            single_results.append(result)
-        batch_results.append(single_results)
-    
+    batch_results, to_test_pool, id_pool = pool_sketch_queries(cache, split, batch_ids,
+        [["".join([output_indexer.get_object(x) for x in seq]) for seq in tokens] for tokens in batch_tokens])
     # print("Pool Size", len(to_test_pool), file=sys.stderr)
-    dataset = cache.dataset
-    worker = SynthWorker(dataset, split)
-    pool = mp.Pool(5)
-    results_pool = pool.map(worker.run, to_test_pool)
-    pool.close()
-
-    for res_id, to_test in enumerate(to_test_pool):
-        batch_results[id_pool[res_id][0]][id_pool[res_id][1]] = results_pool[res_id]
-        cache.soft_write(split, to_test[0], to_test[1], results_pool[res_id])
-        # print(to_test[0], to_test[1], results_pool[res_id], file=sys.stderr)
+    run_sketch_queries(cache, split, to_test_pool, id_pool, batch_results,
+        lambda budget, to_tests: oracle_synth(cache, split, budget, to_tests))
 
     # batch_rewards 1 - 0 set
     # batch_coverage
@@ -226,99 +275,120 @@ def parallel_orcale_reward(batch_tokens, batch_ids, split, cache, output_indexer
     return batch_rewards, num_coverage, num_match
 
 def parallel_synth(test_data, pred_derivations, split, cache):
-    batch_results = []
-
-    id_pool = []
-    to_test_pool = []
-    for i, tokens in enumerate(pred_derivations):
-        single_results = []
-
-        for j, seq in enumerate(tokens): 
-            sketch = seq
-            # result = cache.query(split, test_data[i].id, sketch)
-            result = cache.soft_query(split, test_data[i].id, sketch)
-            if result is None:
-                id_pool.append((i, j))
-                to_test_pool.append((test_data[i].id, sketch))
-            else:
-                # print(split, test_data[i].id, sketch, result, file=sys.stderr)
-                pass
-
-            single_results.append(result)
-        batch_results.append(single_results)
-    
+    batch_results, to_test_pool, id_pool = pool_sketch_queries(cache, split, [ex.id for ex in test_data], pred_derivations)
     # print("Pool Size", len(to_test_pool))
-    timeout = cache.timeout
-    worker = SynthWorker(timeout, split)
-    pool = mp.Pool(5)
-    results_pool = pool.map(worker.run, to_test_pool)
-    pool.close()
-
-    for res_id, to_test in enumerate(to_test_pool):
-        batch_results[id_pool[res_id][0]][id_pool[res_id][1]] = results_pool[res_id]
-        cache.soft_write(split, to_test[0], to_test[1], results_pool[res_id])
-        # print(split, to_test[0], to_test[1], batch_results[id_pool[res_id][0]][id_pool[res_id][1]], file=sys.stderr)
-
+    run_sketch_queries(cache, split, to_test_pool, id_pool, batch_results,
+        lambda budget, to_tests: oracle_synth(cache, split, budget, to_tests))
     return batch_results
 
-def batched_beam_sampling(enc_out_each_word, enc_context_mask, enc_final_states, output_indexer,
-                    model_output_emb, model_dec, decoder_len_limit, beam_size):
+# Beam search over a batch of examples at once. Example b owns the beam_size slots
+# b * beam_size ... (b + 1) * beam_size - 1 of the decoder batch, and every step picks its next
+# beam with one topk over its live hypotheses extended by every token together with its
+# completed hypotheses. Hypotheses are kept as backpointers (the token chosen into each slot at
+# each step and the slot it extends) and only traced back into token lists at the end.
+# With config.grammar, tokens that cannot continue a well-formed sketch are never picked.
+# Returns the ders of every example, best first, and a batch x beam tensor of their sum log
+# probs (differentiable, -inf past the hypotheses an example completed). With token_scores,
+# also the log prob of every token of every der, its EOS last, which add up to its sum log prob.
+def multi_beam_sampling(enc_out_each_word, enc_context_mask, enc_final_states, output_indexer,
+                    model_output_emb, model_dec, decoder_len_limit, beam_size, token_scores=False):
     device = config.device
     EOS = output_indexer.get_index(EOS_SYMBOL)
-    context_inf_mask = get_inf_mask(enc_context_mask)
-
-    completed = []
-    cur_beam = [([], .0, .0)]
-    # 0 toks, 1 score
-    input_words = torch.LongTensor([[output_indexer.index_of(SOS_SYMBOL)]]).to(device)
-    input_states = enc_final_states
-    for _ in range(decoder_len_limit):
-
-        # input_words = torch.LongTensor([[x[1] for x in cur_beam]]).to(device)
+    batch_size = enc_context_mask.size(0)
+    voc_size = model_dec.voc_size
+    num_gen = beam_size * voc_size
+    neg_inf = float("-inf")
+
+    slot_ex = torch.arange(batch_size, device=device).repeat_interleave(beam_size)
+    context_keys = model_dec.project_context(enc_out_each_word).index_select(0, slot_ex)
+    enc_out_each_word = enc_out_each_word.index_select(1, slot_ex)
+    context_inf_mask = get_inf_mask(enc_context_mask).index_select(0, slot_ex)
+    input_states = enc_final_states[0].index_select(1, slot_ex), enc_final_states[1].index_select(1, slot_ex)
+    input_words = torch.full((1, batch_size * beam_size), output_indexer.index_of(SOS_SYMBOL), dtype=torch.long, device=device)
+    first_slot = (torch.arange(batch_size, device=device) * beam_size).unsqueeze(1)
+
+    # scores of live and completed hypotheses, -inf for empty slots; each example starts from one
+    beam_scores = torch.full((batch_size, beam_size), neg_inf, device=device)
+    beam_scores[:, 0] = 0.0
+    comp_scores = torch.full((batch_size, beam_size), neg_inf, device=device)
+    # a completed hypothesis ends with the token chosen at comp_step into comp_slot, -1 when empty
+    comp_step = torch.full((batch_size, beam_size), -1, dtype=torch.long, device=device)
+    comp_slot = torch.zeros((batch_size, beam_size), dtype=torch.long, device=device)
+    grammar = config.grammar
+    if grammar is not None:
+        states = grammar.start_states((batch_size, beam_size))
+    token_trace = []
+    parent_trace = []
+    # log prob of each chosen token, and of the EOS that completed each hypothesis
+    score_trace = []
+    comp_eos_scores = torch.zeros((batch_size, beam_size), device=device)
+    for step in range(decoder_len_limit):
         input_embeded_words = model_output_emb.forward(input_words)
 
-        batch_voc_scores, batch_next_states = model_dec(input_embeded_words, input_states, enc_out_each_word, context_inf_mask)
-        batch_voc_scores = torch.log(batch_voc_scores)
-        batch_voc_scores_cpu = batch_voc_scores.tolist()
-
-        next_beam = []
-        action_pool = []
-        for b_id, voc_scores in enumerate(batch_voc_scores_cpu):
-            base_score = cur_beam[b_id][1]
-            for voc_id, score_cpu in enumerate(voc_scores):
-                # next_beam.append()
-                action_pool.append((b_id, voc_id, base_score + score_cpu, True))
-        
-        for b_id, (_, score, _) in enumerate(completed):
-            action_pool.append((b_id, 0, score, False ))
-        
-        action_pool.sort(key=lambda x: x[2], reverse=True)
-        kept_b_id = []
-        next_input_words = []
-        next_completed = []
-        for b_id, voc_id, new_score, is_gen in action_pool[:beam_size]:
-            if is_gen:
-                if voc_id == EOS:
-                    next_completed.append((cur_beam[b_id][0], new_score, cur_beam[b_id][2] + batch_voc_scores[b_id][voc_id]))
-                else:
-                    next_beam.append((cur_beam[b_id][0] + [voc_id], new_score, cur_beam[b_id][2] + batch_voc_scores[b_id][voc_id]))
-                    next_input_words.append(voc_id)
-                    kept_b_id.append(b_id)
-            else:
-                next_completed.append(completed[b_id])
-        completed = next_completed
-        if not next_beam:
+        batch_voc_scores, batch_next_states = model_dec(input_embeded_words, input_states, enc_out_each_word,
+            context_inf_mask, context_keys)
+        batch_voc_scores = torch.log(batch_voc_scores).view(batch_size, beam_size, voc_size)
+        if grammar is not None:
+            batch_voc_scores = batch_voc_scores.masked_fill(~grammar.allowed_tokens(states), neg_inf)
+
+        # live candidates first, then completed ones, the order batched_beam_sampling used to rank them in
+        gen_scores = (beam_scores.unsqueeze(2) + batch_voc_scores).view(batch_size, num_gen)
+        top_scores, top_ids = torch.cat((gen_scores, comp_scores), 1).topk(beam_size, dim=1)
+        is_gen = top_ids < num_gen
+        tokens = top_ids % voc_size
+        parents = (top_ids // voc_size).clamp(max=beam_size - 1)
+        comp_ids = (top_ids - num_gen).clamp(min=0)
+        found = top_scores > neg_inf
+        is_live = is_gen & (tokens != EOS) & found
+        is_done = (~is_gen | (tokens == EOS)) & found
+
+        beam_scores = torch.where(is_live, top_scores, neg_inf)
+        comp_scores = torch.where(is_done, top_scores, neg_inf)
+        comp_step = torch.where(is_gen, step - 1, comp_step.gather(1, comp_ids))
+        comp_slot = torch.where(is_gen, parents, comp_slot.gather(1, comp_ids))
+        if grammar is not None:
+            states = grammar.advance(states.gather(1, parents), tokens)
+        token_trace.append(tokens)
+        parent_trace.append(parents)
+        if token_scores:
+            picked_scores = batch_voc_scores.view(batch_size, num_gen).gather(1, top_ids.clamp(max=num_gen - 1))
+            comp_eos_scores = torch.where(is_gen, picked_scores, comp_eos_scores.gather(1, comp_ids))
+            score_trace.append(picked_scores)
+        if not is_live.any():
             break
-        kept_b_id = torch.LongTensor(kept_b_id).to(device)
-        input_words = torch.LongTensor([next_input_words]).to(device)
-        cur_beam = next_beam
-        input_states = batch_next_states[0].index_select(1, kept_b_id), batch_next_states[1].index_select(1, kept_b_id)
-
-    completed.sort(key=lambda x: x[1], reverse=True)
-    ders = [x[0] for x in completed]
-    sum_probs = [x[2] for x in completed]
-    
-    # print('---------------')
-    # pred_tokens = [[output_indexer.get_object(t) for t in y] for y in ders]
-    # [print(''.join(p)) for p in pred_tokens]
-    return ders, sum_probs
+        kept_slots = (first_slot + parents).view(-1)
+        input_words = tokens.view(1, -1)
+        input_states = batch_next_states[0].index_select(1, kept_slots), batch_next_states[1].index_select(1, kept_slots)
+
+    # follow the backpointers of every completed hypothesis back to the first step
+    cur_slot = comp_slot
+    comp_tokens = []
+    comp_token_scores = []
+    for step in reversed(range(len(token_trace))):
+        comp_tokens.append(token_trace[step].gather(1, cur_slot))
+        if token_scores:
+            comp_token_scores.append(score_trace[step].gather(1, cur_slot))
+        cur_slot = torch.where(comp_step >= step, parent_trace[step].gather(1, cur_slot), cur_slot)
+    comp_tokens = torch.stack(comp_tokens[::-1], 2)
+
+    comp_scores, order = comp_scores.sort(dim=1, descending=True, stable=True)
+    comp_lens = (comp_step.gather(1, order) + 1).tolist()
+    comp_tokens = comp_tokens.gather(1, order.unsqueeze(2).expand_as(comp_tokens)).tolist()
+    num_found = (comp_scores > neg_inf).sum(1).tolist()
+    batch_ders = [[comp_tokens[b][k][:comp_lens[b][k]] for k in range(num_found[b])] for b in range(batch_size)]
+    if not token_scores:
+        return batch_ders, comp_scores
+    comp_token_scores = torch.stack(comp_token_scores[::-1], 2)
+    comp_token_scores = comp_token_scores.gather(1, order.unsqueeze(2).expand_as(comp_token_scores)).tolist()
+    comp_eos_scores = comp_eos_scores.gather(1, order).tolist()
+    batch_token_scores = [[comp_token_scores[b][k][:comp_lens[b][k]] + [comp_eos_scores[b][k]]
+        for k in range(num_found[b])] for b in range(batch_size)]
+    return batch_ders, comp_scores, batch_token_scores
+
+# beam search over a single example, returns its ders and their sum log probs, best first
+def batched_beam_sampling(enc_out_each_word, enc_context_mask, enc_final_states, output_indexer,
+                    model_output_emb, model_dec, decoder_len_limit, beam_size):
+    batch_ders, sum_probs = multi_beam_sampling(enc_out_each_word, enc_context_mask, enc_final_states, output_indexer,
+                    model_output_emb, model_dec, decoder_len_limit, beam_size)
+    ders = batch_ders[0]
+    return ders, list(sum_probs[0, :len(ders)].unbind())
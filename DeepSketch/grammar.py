@@ -0,0 +1,322 @@
+# Parsing and canonical forms for the two output languages:
+#   sketches (TurkSketch / KB13Sketch), e.g. ?{or(<num>,<let>)} or concat(?{<m0>},<num>)
+#   regexes (Turk / KB13), e.g. .*([<NUM>])&([<LET>]).*
+# Two candidates with the same canonical form have the same meaning, so caches and oracle
+# pools key on canonical forms and each distinct candidate is checked only once.
+from functools import lru_cache
+from external.regexDFA import parse_regex, RegexParseError, ANY_CHAR, MAX_CHAR
+from external.regexDFAEquals import unprocess_regex
+
+class SketchParseError(ValueError):
+    pass
+
+# operator -> argument kinds, 'r' for a regex/sketch, 'i' for an integer
+OPERATORS = {
+    'concat': 'rr',
+    'or': 'rr',
+    'and': 'rr',
+    'sep': 'rr',
+    'not': 'r',
+    'star': 'r',
+    'optional': 'r',
+    'contain': 'r',
+    'startwith': 'r',
+    'endwith': 'r',
+    'repeat': 'ri',
+    'repeatatleast': 'ri',
+    'repeatrange': 'rii',
+}
+COMMUTATIVE = ['or', 'and']
+ASSOCIATIVE = ['or', 'and', 'concat']
+IDEMPOTENT = ['star', 'optional', 'contain', 'startwith', 'endwith']
+
+def tokenize_sketch(sketch):
+    toks = []
+    i = 0
+    while i < len(sketch):
+        c = sketch[i]
+        if c.isspace():
+            i += 1
+        elif c in '?{}(),':
+            toks.append(c)
+            i += 1
+        elif c == '<':
+            end = sketch.find('>', i)
+            if end == -1:
+                raise SketchParseError("unterminated constant at position {}".format(i))
+            toks.append(sketch[i:end + 1])
+            i = end + 1
+        elif c.isalnum():
+            end = i
+            while end < len(sketch) and sketch[end].isalnum():
+                end += 1
+            toks.append(sketch[i:end])
+            i = end
+        else:
+            raise SketchParseError("unexpected character {} at position {}".format(c, i))
+    return toks
+
+# Sketch ASTs are tuples
+#   ('hole', (component, ...))   ('op', name, (arg, ...))   ('const', '<num>')   ('int', '3')
+class SketchParser(object):
+    def __init__(self, toks):
+        self.toks = toks
+        self.pos = 0
+
+    def parse(self):
+        node = self.parse_node(True)
+        if self.pos < len(self.toks):
+            raise SketchParseError("end of sketch expected at token {}".format(self.pos))
+        return node
+
+    def peek(self):
+        return self.toks[self.pos] if self.pos < len(self.toks) else None
+
+    def expect(self, tok):
+        if self.peek() != tok:
+            raise SketchParseError("expected {} at token {}".format(tok, self.pos))
+        self.pos += 1
+
+    def parse_node(self, allow_hole):
+        tok = self.peek()
+        if tok is None:
+            raise SketchParseError("unexpected end of sketch")
+        if tok == '?':
+            if not allow_hole:
+                raise SketchParseError("nested hole at token {}".format(self.pos))
+            self.pos += 1
+            self.expect('{')
+            comps = []
+            if self.peek() != '}':
+                comps.append(self.parse_node(False))
+                while self.peek() == ',':
+                    self.pos += 1
+                    comps.append(self.parse_node(False))
+            self.expect('}')
+            return ('hole', tuple(comps))
+        if tok.startswith('<'):
+            self.pos += 1
+            return ('const', tok)
+        if tok in OPERATORS:
+            self.pos += 1
+            self.expect('(')
+            args = []
+            for i, kind in enumerate(OPERATORS[tok]):
+                if i > 0:
+                    self.expect(',')
+                args.append(self.parse_int() if kind == 'i' else self.parse_node(allow_hole))
+            self.expect(')')
+            return ('op', tok, tuple(args))
+        raise SketchParseError("unexpected token {} at token {}".format(tok, self.pos))
+
+    def parse_int(self):
+        tok = self.peek()
+        if tok is None or not tok.isdigit():
+            raise SketchParseError("integer expected at token {}".format(self.pos))
+        self.pos += 1
+        return ('int', tok)
+
+def parse_sketch(sketch):
+    return SketchParser(tokenize_sketch(sketch)).parse()
+
+def print_sketch(node):
+    if node[0] == 'hole':
+        return '?{' + ','.join(print_sketch(x) for x in node[1]) + '}'
+    if node[0] == 'op':
+        return node[1] + '(' + ','.join(print_sketch(x) for x in node[2]) + ')'
+    return node[1]
+
+def flatten(name, args):
+    flat = []
+    for arg in args:
+        if arg[0] == 'op' and arg[1] == name:
+            flat.extend(flatten(name, arg[2]))
+        else:
+            flat.append(arg)
+    return flat
+
+def has_hole(node):
+    if node[0] == 'hole':
+        return True
+    return node[0] == 'op' and any(has_hole(x) for x in node[2])
+
+def normalize_sketch(node):
+    if node[0] == 'hole':
+        comps = []
+        for comp in node[1]:
+            comp = normalize_sketch(comp)
+            if comp not in comps:
+                comps.append(comp)
+        return ('hole', tuple(comps))
+    if node[0] != 'op':
+        return node
+    name = node[1]
+    args = tuple(normalize_sketch(x) for x in node[2])
+    if name in ASSOCIATIVE:
+        args = flatten(name, args)
+        if name in COMMUTATIVE:
+            # or(x,x) and and(x,x) are x, operands are ordered by their printed form. Every hole
+            # is filled on its own, so repeated operands with holes are kept.
+            seen = set()
+            unique = []
+            for arg in args:
+                if has_hole(arg) or arg not in seen:
+                    seen.add(arg)
+                    unique.append(arg)
+            args = sorted(unique, key=print_sketch)
+        if len(args) == 1:
+            return args[0]
+        # rebuild as a left-nested chain of binary operators
+        node = args[0]
+        for arg in args[1:]:
+            node = ('op', name, (node, arg))
+        return node
+    if name == 'not' and args[0][0] == 'op' and args[0][1] == 'not':
+        return args[0][2][0]
+    if name in IDEMPOTENT and args[0][0] == 'op' and args[0][1] == name:
+        return args[0]
+    return ('op', name, args)
+
+@lru_cache(maxsize=1 << 18)
+def canonical_sketch(sketch):
+    # sketches that do not parse are left alone, the synthesizer decides what they mean
+    try:
+        return print_sketch(normalize_sketch(parse_sketch(sketch)))
+    except SketchParseError:
+        return sketch
+
+# whether a sketch parses; one that does not can only come back "wrong" from the synthesizer
+@lru_cache(maxsize=1 << 18)
+def valid_sketch(sketch):
+    try:
+        parse_sketch(sketch)
+    except SketchParseError:
+        return False
+    return True
+
+# regexes, on the AST of external/regexDFA.py
+REGEX_PREC = {'union': 0, 'inter': 1, 'concat': 2, 'repeat': 3, 'compl': 4}
+
+def normalize_regex(node):
+    kind = node[0]
+    if kind in ('union', 'inter', 'concat'):
+        args = []
+        for child in node[1:]:
+            child = normalize_regex(child)
+            if child[0] == kind:
+                args.extend(child[1:])
+            else:
+                args.append(child)
+        if kind == 'concat':
+            args = [x for x in args if x != ('eps',)]
+            if ('empty',) in args:
+                return ('empty',)
+            if not args:
+                return ('eps',)
+        else:
+            args = sorted(set(args), key=print_regex)
+            if kind == 'union' and len(args) > 1:
+                args = [x for x in args if x != ('empty',)]
+        if len(args) == 1:
+            return args[0]
+        return (kind,) + tuple(args)
+    if kind == 'compl':
+        child = normalize_regex(node[1])
+        if child[0] == 'compl':
+            return child[1]
+        return ('compl', child)
+    if kind == 'repeat':
+        child = normalize_regex(node[1])
+        if (node[2], node[3]) == (1, 1):
+            return child
+        if child[0] == 'repeat' and (node[2], node[3]) == (0, None) and (child[2], child[3]) == (0, None):
+            return child
+        return ('repeat', child, node[2], node[3])
+    if kind == 'chars' and not node[1]:
+        return ('empty',)
+    return node
+
+def escape_char(code):
+    c = chr(code)
+    if c.isascii() and c.isalnum():
+        return c
+    return '\\' + c
+
+def print_ranges(ranges):
+    return ''.join(escape_char(lo) if lo == hi else escape_char(lo) + '-' + escape_char(hi) for lo, hi in ranges)
+
+def print_regex(node, context=0):
+    kind = node[0]
+    prec = REGEX_PREC.get(kind, 5)
+    if kind == 'union':
+        out = '|'.join(print_regex(x, 1) for x in node[1:])
+    elif kind == 'inter':
+        out = '&'.join(print_regex(x, 2) for x in node[1:])
+    elif kind == 'concat':
+        out = ''.join(print_regex(x, 3) for x in node[1:])
+    elif kind == 'repeat':
+        low, high = node[2], node[3]
+        if (low, high) == (0, None):
+            suffix = '*'
+        elif (low, high) == (1, None):
+            suffix = '+'
+        elif (low, high) == (0, 1):
+            suffix = '?'
+        elif high is None:
+            suffix = '{%d,}' % low
+        elif low == high:
+            suffix = '{%d}' % low
+        else:
+            suffix = '{%d,%d}' % (low, high)
+        out = print_regex(node[1], 4) + suffix
+    elif kind == 'compl':
+        out = '~' + print_regex(node[1], 4)
+    elif kind == 'chars':
+        ranges = node[1]
+        if node == ANY_CHAR:
+            out = '.'
+        elif len(ranges) == 1 and ranges[0][0] == ranges[0][1]:
+            out = escape_char(ranges[0][0])
+        elif ranges and ranges[-1][1] == MAX_CHAR:
+            negated = []
+            lo = 0
+            for a, b in ranges:
+                if a > lo:
+                    negated.append((lo, a - 1))
+                lo = b + 1
+            out = '[^' + print_ranges(negated) + ']'
+        else:
+            out = '[' + print_ranges(ranges) + ']'
+    elif kind == 'eps':
+        out = '()'
+    elif kind == 'empty':
+        out = '#'
+    else:
+        out = '@'
+    if prec < context:
+        return '(' + out + ')'
+    return out
+
+@lru_cache(maxsize=1 << 18)
+def canonical_regex(regex):
+    # canonical forms are written in the unprocessed alphabet (<NUM> becomes [0-9] etc.),
+    # which unprocess_regex leaves untouched
+    try:
+        canonical = print_regex(normalize_regex(parse_regex(unprocess_regex(regex))))
+    except (RegexParseError, RecursionError):
+        return regex
+    if any(c.isspace() for c in canonical):
+        return regex
+    return canonical
+
+# whether a regex parses in the dk.brics syntax; one that does not is never equivalent to a gold
+@lru_cache(maxsize=1 << 18)
+def valid_regex(regex):
+    try:
+        parse_regex(unprocess_regex(regex))
+    except RegexParseError:
+        return False
+    except RecursionError:
+        # too deep for the native parser, the jar may still read it
+        return True
+    return True
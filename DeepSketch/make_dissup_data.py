@@ -1,5 +1,6 @@
 # make distant supervision dataset
 from SynthCache import *
+from grammar import canonical_sketch
 from data import *
 from os.path import join
 from eval import read_derivations
@@ -53,14 +54,19 @@ def precache_for_one_example(ex, preds, split, timed_cache):
 
     id_pool = []
     to_test_pool = []
+    pending = {}
     single_results = []
     for j, seq in enumerate(preds): 
-        sketch = "".join(seq)
+        sketch = canonical_sketch("".join(seq))
         # result = cache.query(split, test_data[i].id, sketch)
         result = timed_cache.timed_soft_query(split, ex.id, sketch)
         if result is None:
-            id_pool.append(j)
-            to_test_pool.append((ex.id, sketch))
+            to_test = (ex.id, sketch)
+            if to_test not in pending:
+                pending[to_test] = len(to_test_pool)
+                to_test_pool.append(to_test)
+                id_pool.append([])
+            id_pool[pending[to_test]].append(j)
 
         single_results.append(result)
 
@@ -72,7 +78,8 @@ def precache_for_one_example(ex, preds, split, timed_cache):
     pool.close()
 
     for res_id, to_test in enumerate(to_test_pool):
-        single_results[id_pool[res_id]] = results_pool[res_id]
+        for j in id_pool[res_id]:
+            single_results[j] = results_pool[res_id]
         timed_cache.soft_write(split, to_test[0], to_test[1], results_pool[res_id])
 
     # print(single_results)
@@ -191,7 +198,7 @@ def gt_for_one_example(ex, preds, split, timed_cache):
 
     single_results = []
     for j, seq in enumerate(preds): 
-        sketch = "".join(seq)
+        sketch = canonical_sketch("".join(seq))
         # result = cache.query(split, test_data[i].id, sketch)
         result = timed_cache.timed_soft_query(split, ex.id, sketch)
         single_results.append(result)
@@ -289,9 +296,7 @@ def maximum_timeout():
     args.cache_id = 'cache'
     cache = TimedCache(args.cache_id, args.dataset)
 
-    items_all = []
-    for k, v in cache.data.items():
-        items_all.extend(list(v.values()))
+    items_all = [x for _, _, x, _ in cache.items()]
     
     print(len(items_all))
     # items_all = [x for x in items_all if x[0] == 'true']
@@ -201,14 +201,20 @@ class LuongAttention(nn.Module):
         nn.init.xavier_uniform_(self.attn.weight, gain=1)
         nn.init.constant_(self.attn.bias, 0)
 
+    # projected keys of contexts (c * batch * hidden), batch * c * hidden. They only depend on the
+    # encoder output, so a decoder computes them once per encoded batch and passes them as keys
+    # to every step
+    def project_keys(self, context):
+        return self.attn(context.transpose(0, 1))
+
     # input query: batch * q * hidden, contexts: batch * c * hidden
     # output: batch * len * q * c
-    def forward(self, query, context, inf_mask=None, requires_weight=False):
+    def forward(self, query, context, inf_mask=None, requires_weight=False, keys=None):
         # Calculate the attention weights (energies) based on the given method
         query = query.transpose(0, 1)
         context = context.transpose(0, 1)
 
-        e = self.attn(context)
+        e = self.attn(context) if keys is None else keys
         # e: B * Q * C
         e = torch.matmul(query, e.transpose(1, 2))
         if inf_mask is not None:
@@ -247,7 +253,12 @@ class AttnRNNDecoder(nn.Module):
         nn.init.constant_(self.rnn.bias_hh_l0, 0)
         nn.init.constant_(self.rnn.bias_ih_l0, 0)
 
-    def forward(self, embedded_words, hidden_states, context_states, context_inf_mask):
+    # attention keys of context_states, computed once per encoded batch and passed as context_keys
+    # to forward; expand them along the batch as context_states are expanded for beams or samples
+    def project_context(self, context_states):
+        return self.attn.project_keys(context_states)
+
+    def forward(self, embedded_words, hidden_states, context_states, context_inf_mask, context_keys=None):
 
         outputs, hn = self.rnn(embedded_words, hidden_states)
 
@@ -255,7 +266,7 @@ class AttnRNNDecoder(nn.Module):
         # context_states batch * len * contedxt_hidden_size
         # contexts = torch.bmm(attn_weights.unsqueeze(1), context_states.transpose(0, 1))
         # output_contexts = contexts.view((1, -1, self.context_hidden_size))
-        output_contexts = self.attn(hn[0], context_states, inf_mask=context_inf_mask)
+        output_contexts = self.attn(hn[0], context_states, inf_mask=context_inf_mask, keys=context_keys)
         concated_outpts = torch.cat((outputs, output_contexts), 2)
         # concated_outpts = outputs
         # concated_outpts = F.relu(concated_outpts)
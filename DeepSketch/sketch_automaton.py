@@ -0,0 +1,130 @@
+# Incremental pushdown automaton for the sketch language parsed by grammar.py, run over the
+# tokens of an output indexer so that decoding can mask every token that cannot continue a
+# well-formed sketch. A state is the stack of what the parser still expects (top last), e.g.
+# after "concat ( <num>" it is (')', 'NODE', ','). Stacks are interned to ids, and the first
+# time decoding reaches a state its row of next states and its row of allowed tokens are built
+# and appended to two tables on the device, so a decoding step is two gathers for all beam
+# slots or samples at once.
+import torch
+from grammar import OPERATORS
+from cache_table import InternTable
+from data import PAD_SYMBOL, UNK_SYMBOL, SOS_SYMBOL, EOS_SYMBOL
+from gadget import config
+
+# stack symbols besides the punctuation tokens themselves: a sketch node (holes allowed), a
+# component inside a hole (no nested holes), an integer argument, the components of a hole
+# right after ?{ (it may be empty) and after a component
+NODE, COMP, INT, FIRST_COMPS, MORE_COMPS = 'NODE', 'COMP', 'INT', 'FIRST_COMPS', 'MORE_COMPS'
+# state of a sketch that was ended by EOS
+DONE = 'DONE'
+PUNCTUATION = ['(', ',', ')', '{', '}']
+SPECIAL_SYMBOLS = [PAD_SYMBOL, UNK_SYMBOL, SOS_SYMBOL, EOS_SYMBOL]
+
+# stack after tok, None if tok cannot come next
+def next_stack(stack, tok):
+    if not stack:
+        return None
+    top, rest = stack[-1], stack[:-1]
+    if top in PUNCTUATION:
+        return rest if tok == top else None
+    if top == INT:
+        return rest if tok.isdigit() else None
+    if top == MORE_COMPS:
+        if tok == ',':
+            return rest + (MORE_COMPS, COMP)
+        return rest if tok == '}' else None
+    if top == FIRST_COMPS:
+        if tok == '}':
+            return rest
+        return next_stack(rest + (MORE_COMPS, COMP), tok)
+    if tok == '?':
+        return rest + (FIRST_COMPS, '{') if top == NODE else None
+    if tok.startswith('<') and tok.endswith('>') and tok not in SPECIAL_SYMBOLS:
+        return rest
+    if tok in OPERATORS:
+        # arguments are pushed last first, so the first one is on top after the '('
+        expected = [')']
+        kinds = OPERATORS[tok]
+        for i in reversed(range(len(kinds))):
+            expected.append(INT if kinds[i] == 'i' else top)
+            if i > 0:
+                expected.append(',')
+        expected.append('(')
+        return rest + tuple(expected)
+    return None
+
+class SketchAutomaton(object):
+    def __init__(self, output_indexer, device):
+        self.tokens = [output_indexer.get_object(i) for i in range(len(output_indexer))]
+        self.eos = output_indexer.index_of(EOS_SYMBOL)
+        self.device = device
+        self.stacks = InternTable()
+        # nothing continues the dead state; a finished sketch only continues with EOS
+        self.dead = self.stacks.intern(None)
+        self.done = self.stacks.intern(DONE)
+        self.start = self.stacks.intern((NODE,))
+        # state x token -> state, and whether the token is allowed
+        self.next_states = torch.zeros((0, len(self.tokens)), dtype=torch.long, device=device)
+        self.allowed = torch.zeros((0, len(self.tokens)), dtype=torch.bool, device=device)
+        self.built = []
+        self.grow()
+
+    # number of states with a row, built or not
+    def __len__(self):
+        return self.next_states.size(0)
+
+    def build_row(self, state):
+        stack = self.stacks[state]
+        row = []
+        for tok_id, tok in enumerate(self.tokens):
+            if stack is None or stack == DONE:
+                nxt = self.done if stack == DONE and tok_id == self.eos else self.dead
+            elif tok_id == self.eos:
+                nxt = self.done if not stack else self.dead
+            else:
+                nxt = next_stack(stack, tok)
+                nxt = self.dead if nxt is None else self.stacks.intern(nxt)
+            row.append(nxt)
+        return row
+
+    # adds rows for the states interned since the last call, they allow nothing until built
+    def grow(self):
+        grow = len(self.stacks) - len(self)
+        if grow:
+            self.next_states = torch.cat((self.next_states,
+                torch.full((grow, len(self.tokens)), self.dead, dtype=torch.long, device=self.device)), 0)
+            self.allowed = torch.cat((self.allowed,
+                torch.zeros((grow, len(self.tokens)), dtype=torch.bool, device=self.device)), 0)
+            self.built.extend([False] * grow)
+
+    # builds the rows of the states in states that have none yet, only states decoding reaches
+    # are built
+    def expand(self, states):
+        missing = [x for x in states.unique().tolist() if not self.built[x]]
+        if not missing:
+            return
+        rows = torch.LongTensor([self.build_row(x) for x in missing]).to(self.device)
+        self.grow()
+        missing_ids = torch.LongTensor(missing).to(self.device)
+        self.next_states[missing_ids] = rows
+        self.allowed[missing_ids] = rows != self.dead
+        for x in missing:
+            self.built[x] = True
+
+    def start_states(self, size):
+        return torch.full(size, self.start, dtype=torch.long, device=self.device)
+
+    # states ... x voc mask of the tokens allowed next
+    def allowed_tokens(self, states):
+        self.expand(states)
+        return self.allowed[states]
+
+    # states after tokens, for states whose tokens were asked for
+    def advance(self, states, tokens):
+        return self.next_states[states, tokens]
+
+# the automaton of a sketch dataset (TurkSketch, KB13Sketch, ...) on the device decoding runs on
+def make_sketch_automaton(dataset, output_indexer):
+    if 'Sketch' not in dataset:
+        raise ValueError("Grammar masks are only defined for sketch datasets, not {}".format(dataset))
+    return SketchAutomaton(output_indexer, config.device)
@@ -0,0 +1,5 @@
+# the modules of DeepSketch are imported from the folder they are run in
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+import os
+import pytest
+from SynthCache import SynthCache, DFACache
+from cache_table import SynthTable
+from cache_tool import CacheFiles, drop
+
+def make_pickle_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("caches")
+    cache = SynthCache("test", "TurkSketch", store="pickle")
+    cache.soft_write("train", 1, "<num>", "true")
+    cache.soft_write("val", 2, "<let>", "false")
+    cache.rewrite()
+    return cache
+
+def test_clean_split_of_a_pickle_cache(tmp_path, monkeypatch):
+    cache = make_pickle_cache(tmp_path, monkeypatch)
+    cache.clean_split("val")
+    cache.rewrite()
+    cache.close()
+    cache = SynthCache("test", "TurkSketch", store="pickle")
+    assert cache.soft_query("train", 1, "<num>") == "true"
+    assert cache.soft_query("val", 2, "<let>") is None
+
+def test_pickle_cache_has_one_job_at_a_time(tmp_path, monkeypatch):
+    cache = make_pickle_cache(tmp_path, monkeypatch)
+    with pytest.raises(ValueError):
+        SynthCache("test", "TurkSketch", store="pickle")
+    # the log store is for caches shared by several jobs
+    SynthCache("test", "TurkSketch", store="log")
+    cache.close()
+    cache = SynthCache("test", "TurkSketch", store="pickle")
+    assert cache.soft_query("val", 2, "<let>") == "false"
+
+def test_cache_tool_drops_a_split_of_a_pickle_cache(tmp_path, monkeypatch):
+    cache = make_pickle_cache(tmp_path, monkeypatch)
+    # a job that has the cache open would write the split back
+    with pytest.raises(ValueError):
+        drop(CacheFiles("Turk-test"), ["val"])
+    cache.close()
+    drop(CacheFiles("Turk-test"), ["val"])
+    assert not os.path.exists(os.path.join("caches", "Turk-test.log"))
+    cache = SynthCache("test", "TurkSketch", store="pickle")
+    assert cache.soft_query("train", 1, "<num>") == "true"
+    assert cache.soft_query("val", 2, "<let>") is None
+
+def test_bounded_table_releases_evicted_strings():
+    table = SynthTable(capacity=100, pinned=["true"])
+    for i in range(10000):
+        table.put("train-{}".format(i), "<num>{}".format(i), "true" if i == 0 else "false", 2.0)
+    assert len(table) == 100
+    assert len(table.keys.ids) == 100 and len(table.sketches.ids) == 100
+    # ids of released strings are reused
+    assert len(table.keys) <= 101
+    assert table.get("train-0", "<num>0") == ("true", 2.0)
+    table.drop_prefix("train-")
+    assert len(table.keys.ids) == 0 and len(table.sketches.ids) == 0
+
+def test_dfa_eviction_keeps_the_inference_of_the_pairs_left(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("caches")
+    cache = DFACache("test", "Turk", capacity=10)
+    regexes = ["<{}>".format(x) for x in "abcdefghij"]
+    for i in range(10):
+        for j in range(i + 1, 10):
+            cache.record(regexes[i], regexes[j], "true" if i % 3 == j % 3 else "false", persist=False)
+    assert cache.evictions > 0
+    full = DFACache.__new__(DFACache)
+    full.parent, full.size, full.unequal, full.members = {}, {}, {}, {}
+    for (r1, r2), result in cache.data.items():
+        full.relate(r1, r2, result)
+    assert set(full.parent) == set(cache.parent)
+    for r1 in full.parent:
+        for r2 in full.parent:
+            assert (full.find(r1) == full.find(r2)) == (cache.find(r1) == cache.find(r2))
+            assert (full.find(r2) in full.unequal[full.find(r1)]) == (cache.find(r2) in cache.unequal[cache.find(r1)])
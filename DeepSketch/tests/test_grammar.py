@@ -0,0 +1,9 @@
+from grammar import canonical_sketch
+
+def test_repeated_hole_operands_are_kept():
+    assert canonical_sketch("and(?{<let>},?{<let>})") == "and(?{<let>},?{<let>})"
+    assert canonical_sketch("or(?{<num>},or(<let>,?{<num>}))") == "or(or(<let>,?{<num>}),?{<num>})"
+
+def test_repeated_operands_without_holes_are_dropped():
+    assert canonical_sketch("and(<let>,<let>)") == "<let>"
+    assert canonical_sketch("or(<num>,or(<let>,<num>))") == canonical_sketch("or(<let>,<num>)")
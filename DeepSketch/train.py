@@ -10,6 +10,9 @@ from models import *
 from data import *
 from utils import *
 from SynthCache import *
+from cost_model import CostModel
+from cache_stats import cache_stats_json
+from sketch_automaton import make_sketch_automaton
 import math
 from external.regexDFAEquals import dfa_eual_test
 
@@ -56,6 +59,19 @@ def _parse_args():
     parser.add_argument('--warm_model_id', type=str, default=None, help='warm start model')
     parser.add_argument('--cache_id', type=str, default="cache", help='cache_id')
     parser.add_argument('--timeout', type=int, default=2, help='timeout')
+    parser.add_argument('--dfa_engine', type=str, default="native", help='DFA equivalence engine, native or jar')
+    parser.add_argument('--oracle_workers', type=int, default=5, help='size of the oracle process pool')
+    parser.add_argument('--synth_budgets', type=str, default=None, help='comma separated synthesizer budgets in seconds, timed out sketches are retried under the next one')
+    parser.add_argument('--cost_model', type=str, default=None, help='synthesis cost model file, sketches are synthesized cheapest first')
+    parser.add_argument('--skip_timeout_p', type=float, default=None, help='skip sketches the cost model gives a larger chance of timing out')
+    parser.add_argument('--dispatcher', type=str, default="pool", help='how oracle calls are run, pool or async')
+    parser.add_argument('--cache_store', type=str, default="log", help='cache storage, log, indexed or pickle')
+    parser.add_argument('--cache_capacity', type=int, default=None, help='most cache entries kept in memory, unbounded by default')
+    parser.add_argument('--cache_eviction', type=str, default="lru", help='which entries a full cache evicts, lru or lfu')
+    parser.add_argument('--checkpoint_interval', type=float, default=None, help='write cache results in the background every this many seconds instead of at the end of every epoch')
+    parser.add_argument('--checkpoint_entries', type=int, default=1000, help='with --checkpoint_interval, also write once this many results are waiting')
+    parser.add_argument('--no_pin_true', dest='pin_true', default=True, action='store_false', help='let a full cache evict true entries too')
+    parser.add_argument('--grammar_mask', default=False, action='store_true', help='only sample and beam search well-formed sketches')
 
     args = parser.parse_args()
     return args
@@ -66,6 +82,7 @@ def train_decode_with_output_of_encoder(enc_out_each_word, enc_context_mask,
                             model_output_emb, model_dec, decoder_len_limit, p_forcing):
     batch_size = enc_context_mask.size(0)
     context_inf_mask = get_inf_mask(enc_context_mask)
+    context_keys = model_dec.project_context(enc_out_each_word)
     input_words = torch.from_numpy(np.asarray([output_indexer.index_of(SOS_SYMBOL) for _ in range(batch_size)]))
     input_words = input_words.to(config.device)
     input_words = input_words.unsqueeze(1)
@@ -81,7 +98,7 @@ def train_decode_with_output_of_encoder(enc_out_each_word, enc_context_mask,
         for i in range(output_max_len):
             input_embeded_words = model_output_emb.forward(input_words)
             input_embeded_words = input_embeded_words.reshape((1, batch_size, -1))
-            voc_scores, dec_hidden_states = model_dec(input_embeded_words, dec_hidden_states, enc_out_each_word, context_inf_mask)
+            voc_scores, dec_hidden_states = model_dec(input_embeded_words, dec_hidden_states, enc_out_each_word, context_inf_mask, context_keys)
             input_words = gt_out[:, i].view((-1, 1))
 
             loss += masked_cross_entropy(voc_scores, gt_out[:, i], gt_out_mask[:, i])
@@ -90,7 +107,7 @@ def train_decode_with_output_of_encoder(enc_out_each_word, enc_context_mask,
         for i in range(output_max_len):
             input_embeded_words = model_output_emb.forward(input_words)
             input_embeded_words = input_embeded_words.reshape((1, batch_size, -1))
-            voc_scores, dec_hidden_states = model_dec(input_embeded_words, dec_hidden_states, enc_out_each_word, context_inf_mask)
+            voc_scores, dec_hidden_states = model_dec(input_embeded_words, dec_hidden_states, enc_out_each_word, context_inf_mask, context_keys)
             output_words = voc_scores.argmax(dim=1, keepdim=True)
             input_words = output_words.detach()
             loss += masked_cross_entropy(voc_scores, gt_out[:, i], gt_out_mask[:, i])
@@ -311,18 +328,28 @@ def monte_carlo_sampling(enc_out_each_word, enc_context_mask,
     input_words = input_words.to(device)
     input_words = input_words.unsqueeze(1)
     input_words = input_words.repeat(sample_size, 1)
+    context_keys = model_dec.project_context(enc_out_each_word).repeat(sample_size, 1, 1)
     enc_out_each_word = enc_out_each_word.repeat(1, sample_size, 1)
     dec_hidden_states = (enc_final_states[0].repeat(1, sample_size, 1), enc_final_states[1].repeat(1, sample_size, 1))
     # expand sample size time
+    grammar = config.grammar
+    if grammar is not None:
+        states = grammar.start_states((expand_size,))
 
     output_trace = []
     prob_trace = []
     for i in range(output_max_len):
         input_embeded_words = model_output_emb.forward(input_words)
         input_embeded_words = input_embeded_words.reshape((1, expand_size, -1))
-        voc_scores, dec_hidden_states = model_dec(input_embeded_words, dec_hidden_states, enc_out_each_word, context_inf_mask)
+        voc_scores, dec_hidden_states = model_dec(input_embeded_words, dec_hidden_states, enc_out_each_word, context_inf_mask, context_keys)
+        if grammar is not None:
+            # the model renormalized over the tokens that keep the sketch well-formed
+            voc_scores = voc_scores.masked_fill(~grammar.allowed_tokens(states), 0.0)
+            voc_scores = voc_scores / voc_scores.sum(1, keepdim=True)
         output_words = torch.multinomial(voc_scores, 1)
         input_words = output_words.detach()
+        if grammar is not None:
+            states = grammar.advance(states, input_words.view(-1))
         output_trace.append(input_words)
         prob_trace.append(torch.gather(voc_scores, 1, input_words))
     # output trace & probtrace : exandsize, 1
@@ -362,34 +389,18 @@ def build_output_tokens(output_trace, prob_trace, output_indexer, batch_size, sa
 def naive_beam_sampling(enc_out_each_word, enc_context_mask,
                             enc_final_states, output_indexer,
                             model_output_emb, model_dec, output_max_len):
-    batch_size = enc_context_mask.size(0)
     sample_size = args.sample_size
 
     # target a list of B * sample_size
     # a list of sum log probas B * sample_size
-    enc_out_each_word_list = enc_out_each_word.unbind(1)
-    enc_context_mask_list = enc_context_mask.unbind(0)
-    enc_final_h_list = enc_final_states[0].unbind(1)
-    enc_final_c_list = enc_final_states[1].unbind(1)
-
-    batch_tokens = []
-    batch_probs = []
-    for id_exs in range(batch_size):
-        single_tokens, single_probs = batched_beam_sampling(enc_out_each_word_list[id_exs].unsqueeze(1), enc_context_mask_list[id_exs].unsqueeze(0),
-            (enc_final_h_list[id_exs].unsqueeze(1), enc_final_c_list[id_exs].unsqueeze(1)), output_indexer, model_output_emb, model_dec, output_max_len, sample_size)
-
-        # ensure correctness
-        # if len(batch_tokens) < sample_size:
-        for _ in range(len(single_tokens),sample_size):
-            single_tokens.append([])
-            x = torch.tensor(-1000000.0).to(config.device)
-            single_probs.append(x)
-
-        single_probs = torch.stack(single_probs).to(config.device)
-        batch_tokens.append(single_tokens)
-        batch_probs.append(single_probs)
+    batch_tokens, batch_probs = multi_beam_sampling(enc_out_each_word, enc_context_mask, enc_final_states,
+        output_indexer, model_output_emb, model_dec, output_max_len, sample_size)
 
-    batch_probs = torch.stack(batch_probs)
+    # ensure correctness
+    for single_tokens in batch_tokens:
+        for _ in range(len(single_tokens), sample_size):
+            single_tokens.append([])
+    batch_probs = batch_probs.masked_fill(batch_probs == float("-inf"), -1000000.0)
     return batch_tokens, batch_probs
 
 def acc_reward_loss(acc_log_probs, output_rewards):
@@ -481,6 +492,7 @@ def oracle_perplexity(test_loader,
 
     _do_montecarlo = args.do_montecarlo
     args.do_montecarlo = False
+    stats_mark = cache.stats.snapshot()
     with torch.no_grad():
         for batch_idx, batch_data in enumerate(test_iter):
             # print("Evaluating {}".format(batch_idx), file=sys.stderr)
@@ -499,6 +511,7 @@ def oracle_perplexity(test_loader,
             epoch_reward += reward
     perperlexity = epoch_match
     args.do_montecarlo = _do_montecarlo
+    print(cache_stats_json(cache, "val", stats_mark))
     return -perperlexity
 
 def eval_mode(*args):
@@ -560,6 +573,7 @@ def train_model_encdec_rl(train_data, test_data, input_indexer, output_indexer,
         epoch_coverage = 0
         epoch_match = 0
         epoch_reward = 0.0
+        stats_mark = cache.stats.snapshot()
         for batch_idx, batch_data in enumerate(train_iter):
             # print("Training {} {}".format(epoch, batch_idx), file=sys.stderr)
             optimizer.zero_grad()
@@ -587,6 +601,7 @@ def train_model_encdec_rl(train_data, test_data, input_indexer, output_indexer,
             optimizer.step()
 
         print('epoch {}, train coverage: {}, train match {}, train loss {}, train reward {}'.format(epoch, epoch_coverage, epoch_match, (epoch_loss / num_batch), (epoch_reward / num_batch)))
+        print(cache_stats_json(cache, "train", stats_mark, epoch=epoch))
 
         # if (epoch < args.saving_from) or (args.model_id is None):
         #     continue
@@ -603,6 +618,7 @@ def train_model_encdec_rl(train_data, test_data, input_indexer, output_indexer,
         if dev_perplexity <= best_dev_perplexity:
             best_dev_perplexity = dev_perplexity
             torch.save(parameters, get_model_file(args.dataset, args.model_id + "-best"))
+    print(cache_stats_json(cache, "run"))
 
     # parser = Seq2SeqSemanticParser(input_indexer, output_indexer, model_input_emb, model_enc, model_output_emb, model_dec, args)
     # return parser
@@ -658,9 +674,22 @@ if __name__ == '__main__':
     if args.do_rl or args.do_oracle_val:
         args.oracle_mode = "sketch" if 'Sketch' in args.dataset else 'regex'
         if args.oracle_mode == 'sketch':
-            cache = SynthCache(args.cache_id, args.dataset)
+            cache = SynthCache(args.cache_id, args.dataset, store=args.cache_store,
+                capacity=args.cache_capacity, eviction=args.cache_eviction, pin_true=args.pin_true)
+            if args.synth_budgets is not None:
+                cache.budget_schedule = [float(x) for x in args.synth_budgets.split(',')]
+        else:
+            cache = DFACache(args.cache_id, args.dataset, args.dfa_engine, args.cache_store,
+                args.cache_capacity, args.cache_eviction, args.pin_true)
+        if args.checkpoint_interval is not None:
+            cache.start_checkpointing(args.checkpoint_interval, args.checkpoint_entries)
+        if args.cost_model is not None:
+            config.cost_model = CostModel.load(args.cost_model)
+            config.skip_timeout_p = args.skip_timeout_p
+        if args.dispatcher == 'async':
+            config.oracle_dispatcher = OracleDispatcher(args.oracle_workers)
         else:
-            cache = DFACache(args.cache_id, args.dataset)
+            config.oracle_pool = OraclePool(args.oracle_workers)
 
     print("Pytroch using device ", config.device)
     random.seed(args.seed)
@@ -668,6 +697,8 @@ if __name__ == '__main__':
     # Load the training and test data
     train, dev, input_indexer, output_indexer = load_datasets(args.dataset)
     train_data_indexed, dev_data_indexed = index_datasets(train, dev, input_indexer, output_indexer, args.decoder_len_limit)
+    if args.grammar_mask:
+        config.grammar = make_sketch_automaton(args.dataset, output_indexer)
 
     print("Original %i train exs, %i dev exs" % (len(train_data_indexed), len(dev_data_indexed)))
     if args.do_rl:
@@ -682,6 +713,8 @@ if __name__ == '__main__':
         print('After filter', len(train_data_indexed), len(dev_data_indexed))
 
     print("%i train exs, %i dev exs, %i input types, %i output types" % (len(train_data_indexed), len(dev_data_indexed), len(input_indexer), len(output_indexer)))
+    if (args.do_rl or args.do_oracle_val) and args.oracle_mode == 'regex':
+        cache.precompile_golds(["".join(ex.y_tok) for ex in train_data_indexed + dev_data_indexed])
     # print("Input indexer: %s" % input_indexer)
     # print("Output indexer: %s" % output_indexer)
     # print("Here are some examples post tokenization and indexing:")
@@ -703,5 +736,10 @@ if __name__ == '__main__':
         print("KeyboardInterrupt Catched")
         if args.do_rl or args.do_oracle_val:
             cache.rewrite()
+    finally:
+        close_oracle_pool()
+        if args.do_rl or args.do_oracle_val:
+            cache.stop_checkpointing()
     if args.do_rl or args.do_oracle_val:
         cache.rewrite()
+        cache.close()